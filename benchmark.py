@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import resource
+import contextlib
+import subprocess
+import fplsync
+
+# bits of names used to build up a fake library, some of them deliberately not ascii
+ARTISTS = ["The Band", "Sigur R\u00f3s", "Bj\u00f6rk", "\u5742\u672c\u9f8d\u4e00", "Motorhead",
+           "\u0414\u0414\u0422", "Caf\u00e9 Tacvba", "X [Live] *?"]
+WORDS = ["Song", "Night", "\u00c9t\u00e9", "Road", "\u591c", "Blue", "\u041b\u0435\u0442\u043e",
+         "Atlas", "Trucker's", "Home"]
+EXTENSIONS = [".mp3", ".flac", ".ogg", ".m4a"]
+
+
+class SyntheticLibrary:
+	"""A fake foobar2000 setup in a temp directory, with a library and a playlist of it
+
+	The library has artist/album(/disc) directories full of sparse files, so it takes up almost
+	no real space.  The playlist refers to every song, and a fraction of them more than once.
+	"""
+
+	def __init__(self, song_count, duplicate_fraction=0.1, seed=0):
+		self.song_count = song_count
+		self.random = random.Random(seed)
+		self.temp = tempfile.mkdtemp(prefix="fplbench")
+		self.config = fplsync.Config()
+		self.config.playlist_source = os.path.join(self.temp, "fb2k_playlists")
+		self.config.source = os.path.join(self.temp, "source")
+		self.config.dest = os.path.join(self.temp, "dest")
+		self.config.playlist_dest = os.path.join(self.temp, "playlists")
+		self.config.fb2k_source_mapping = "F:\\Music"
+		# plenty of room, the point is to measure planning rather than run out of space
+		self.config.free_override = 2 ** 60
+		self.config.total_override = 2 ** 61
+		for directory in [self.config.playlist_source, self.config.source, self.config.dest,
+		                  self.config.playlist_dest]:
+			os.mkdir(directory)
+		self.relative_paths = self.make_songs()
+		self.playlist_paths = self.relative_paths + self.random.sample(
+			self.relative_paths, int(len(self.relative_paths) * duplicate_fraction))
+		self.random.shuffle(self.playlist_paths)
+		self.fpl = os.path.join(self.config.playlist_source, "0.fpl")
+		self.write_fpl()
+		self.write_index()
+
+	def make_songs(self):
+		relative_paths = []
+		while len(relative_paths) < self.song_count:
+			artist = self.random.choice(ARTISTS) + " " + str(len(relative_paths))
+			for album in range(self.random.randint(1, 4)):
+				album_dir = os.path.join(artist, " ".join(self.random.sample(WORDS, 2)) + " " +
+				                         str(album))
+				if self.random.random() < 0.2:
+					album_dir = os.path.join(album_dir, "Disc " + str(self.random.randint(1, 3)))
+				os.makedirs(os.path.join(self.config.source, album_dir))
+				for track in range(self.random.randint(8, 16)):
+					name = "%02d - %s%s" % (track + 1, " ".join(self.random.sample(WORDS, 3)),
+					                        self.random.choice(EXTENSIONS))
+					relative_path = os.path.join(album_dir, name)
+					with open(os.path.join(self.config.source, relative_path), "wb") as f:
+						f.truncate(self.random.randint(2 * 1024 * 1024, 40 * 1024 * 1024))
+					relative_paths.append(relative_path)
+		return relative_paths[:self.song_count]
+
+	def write_fpl(self):
+		"""Write the playlist, with some junk between entries like a real fpl"""
+		with open(self.fpl, "wb") as f:
+			f.write(b'\xe1\xa0\x9c\x91\xf8\x3c\x77\x42\x85\x2f\x3b\xdb\x3a\x52\x1a\xb8')
+			for relative_path in self.playlist_paths:
+				windows_path = "F:\\Music\\" + relative_path.replace(os.path.sep, "\\")
+				f.write(b'\x00file://' + windows_path.encode('utf-8') + b'\x00')
+				f.write(bytes(self.random.getrandbits(8) or 1 for i in range(24)))
+
+	def write_index(self):
+		name = "Everything".encode('utf-8')
+		with open(os.path.join(self.config.playlist_source, "index.dat"), "wb") as f:
+			f.write(b'\x01\x00\x00\x00\x00\x00' + b'0.fpl' + len(name).to_bytes(2, sys.byteorder)
+			        + b'\x00\x00' + name + b'\x00\x00\x00\x00')
+
+	def remove(self):
+		shutil.rmtree(self.temp)
+
+
+@contextlib.contextmanager
+def timed(results, stage):
+	"""Record wall and cpu time of the block in results[stage], hiding anything it prints"""
+	wall = time.perf_counter()
+	cpu = time.process_time()
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		yield
+	results[stage] = {"wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu}
+
+
+def run_benchmark(song_count, engine):
+	"""Time each stage of a dry-run sync of a synthetic library, return a dict of results"""
+	library = SyntheticLibrary(song_count)
+	try:
+		config = library.config
+		config.engine = engine
+		config.dry_run = True
+		results = {}
+		with timed(results, "playlist_index"):
+			index = fplsync.PlaylistIndex(config)
+		with timed(results, "parse"):
+			paths = list(fplsync.iter_fpl_paths(library.fpl))
+		with timed(results, "song_index"):
+			songs = list(index.song_index.get_songs(paths))
+		with timed(results, "prefetch_sizes"):
+			index.song_index.prefetch_sizes(songs)
+		with timed(results, "find_max_size"):
+			director = fplsync.SyncDirector(config)
+		with timed(results, "add_playlist"):
+			director.add_playlist(index.get_playlist("Everything"))
+		with timed(results, "add_songs"):
+			director.add_songs(songs)
+		with timed(results, "write_include_file"):
+			director.write_include_file()
+		if engine != "rsync" or shutil.which("rsync") is not None:
+			with timed(results, "transfer"):
+				director.transfer()
+		return {
+			"songs": song_count,
+			"playlist_entries": len(paths),
+			"fpl_bytes": os.path.getsize(library.fpl),
+			"indexed_songs": len(index.song_index),
+			"planned_bytes": director.cumulative_size,
+			"stages": results,
+		}
+	finally:
+		library.remove()
+
+
+def git_revision():
+	"""Return the commit fplsync is at, if it's in a git checkout"""
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], universal_newlines=True,
+		                               cwd=os.path.dirname(os.path.abspath(fplsync.__file__)),
+		                               stderr=subprocess.DEVNULL).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	ap = argparse.ArgumentParser(description="Time fplsync's stages against synthetic libraries\
+	                             and print the results as JSON")
+	ap.add_argument("--songs", type=int, nargs='+', default=[10000], help="number of songs in the\
+	                library, can give several sizes (default: %(default)s)")
+	ap.add_argument("--engine", choices=sorted(fplsync.TRANSFER_ENGINES), default="native",
+	                help="engine used for the dry-run transfer (default: %(default)s)")
+	ap.add_argument("--output", "-o", help="write the JSON here instead of stdout")
+	args = ap.parse_args()
+
+	report = {
+		"revision": git_revision(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"engine": args.engine,
+		"runs": [run_benchmark(song_count, args.engine) for song_count in args.songs],
+		# kilobytes on linux
+		"max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+	}
+	if args.output is None:
+		json.dump(report, sys.stdout, indent=2)
+		print()
+	else:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+	main()
@@ -8,6 +8,7 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import math
 import re
 import os
+import mmap
 import sys
 import ntpath
 import argparse
@@ -15,7 +16,26 @@ import tempfile
 import shutil
 import subprocess
 import random
-import uuid
+import hashlib
+import concurrent.futures
+import sqlite3
+import threading
+import contextlib
+import time
+import json
+import copy
+import select
+import struct
+import ctypes
+import ctypes.util
+import codecs
+import shlex
+import fcntl
+
+try:
+	import numpy
+except ImportError:
+	numpy = None # add_songs sticks to plain loops without it
 
 
 class Config:
@@ -35,11 +55,40 @@ class Config:
 		self.dont_delete_temp = False # for debugging, not exposed to CLI
 		self.free_override = None
 		self.total_override = None
+		self.cache_dir = None
+		self.threads = 8
+		self.engine = "rsync"
+		self.link = None # None, or one of LINK_MODES to make files in dest share data with source
+		self.use_manifest = True
+		self.fill = "first"
+		self.files_from = False
+		self.devices = [] # --device specs for extra destinations, see parse_device
+		self.device_jobs = 4
+		self.stats_format = None # if set, the CLI prints a Stats report in this format at the end
+		self.case_sensitive = False # whether fpl paths differing only in case are different songs
+		self.dedupe_inodes = False
+		self.transcode = [] # extensions of songs to transcode, like ".flac"
+		self.transcode_ext = ".opus"
+		self.transcode_command = DEFAULT_TRANSCODE_COMMAND
+		self.transcode_jobs = os.cpu_count() or 1
+		self.resume = False
+		self.verify = None # None, or one of VERIFY_MODES to check songs in dest after transferring
+		self.export_plan = None # path to save the plan to before transferring
+		self.apply_plan = None # path of a plan to transfer instead of planning
+		self.watch = False
+		self.watch_interval = 2.0 # seconds between checks for changes when polling, and for dest
 	
-	def validate(self):
-		dirprops = ["playlist_source", "source", "dest"]
-		if self.playlist_dest is not None:
-			dirprops.append("playlist_dest")
+	def validate(self, require_dest=True):
+		"""Check and normalize the config, raising an exception if it's invalid
+
+		If require_dest is False, dest and playlist_dest don't need to exist yet, like when
+		watching for a device that hasn't been plugged in.
+		"""
+		dirprops = ["playlist_source", "source"]
+		if require_dest:
+			dirprops.append("dest")
+			if self.playlist_dest is not None:
+				dirprops.append("playlist_dest")
 		for prop in dirprops:
 			value = getattr(self, prop)
 			if value is None or not os.path.isdir(value):
@@ -58,7 +107,61 @@ class Config:
 				self.min_free = self.size_str_to_bytes(self.min_free)
 			if self.min_free < 0:
 				raise ValueError("min_free must be grater than zero")
+		if self.cache_dir is not None:
+			os.makedirs(self.cache_dir, exist_ok=True)
+		if not isinstance(self.threads, int) or self.threads < 1:
+			raise ValueError("threads must be a positive int")
+		if self.engine not in TRANSFER_ENGINES:
+			raise ValueError("engine must be one of " + ", ".join(sorted(TRANSFER_ENGINES)))
+		if self.link is not None:
+			if self.link not in LINK_MODES:
+				raise ValueError("link must be one of " + ", ".join(LINK_MODES))
+			self.engine = "native" # rsync can't clone files
+		if self.verify is not None and self.verify not in VERIFY_MODES:
+			raise ValueError("verify must be one of " + ", ".join(VERIFY_MODES))
+		if self.fill not in FILL_MODES:
+			raise ValueError("fill must be one of " + ", ".join(FILL_MODES))
+		if not isinstance(self.device_jobs, int) or self.device_jobs < 1:
+			raise ValueError("device_jobs must be a positive int")
+		self.transcode = [extension.lower() if extension.startswith(".") else "." + extension.lower()
+		                  for extension in self.transcode]
+		if not self.transcode_ext.startswith("."):
+			self.transcode_ext = "." + self.transcode_ext
+		if "{input}" not in self.transcode_command or "{output}" not in self.transcode_command:
+			raise ValueError("transcode_command must contain {input} and {output}")
+		if not isinstance(self.transcode_jobs, int) or self.transcode_jobs < 1:
+			raise ValueError("transcode_jobs must be a positive int")
+		if self.watch_interval <= 0:
+			raise ValueError("watch_interval must be greater than zero")
 	
+	def for_destination(self, dest, playlist_dest=None, max_size=None, min_free=None):
+		"""Return a copy of this config that syncs to another destination device
+
+		Everything about the source stays the same, but the destination and its limits are
+		replaced (not inherited).
+		"""
+		config = copy.copy(self)
+		config.dest = dest
+		config.playlist_dest = playlist_dest
+		config.max_size = max_size
+		config.min_free = min_free
+		config.free_override = None
+		config.total_override = None
+		config.devices = []
+		return config
+
+	def parse_device(self, spec):
+		"""Parse a --device argument like "dest=/media/b,max_size=2G" into a dict"""
+		device = {}
+		for item in spec.split(","):
+			key, equals, value = item.partition("=")
+			if key not in ("dest", "playlist_dest", "max_size", "min_free") or equals == "":
+				raise ValueError("Bad device option '" + item + "' in " + spec)
+			device[key] = value
+		if "dest" not in device:
+			raise ValueError("Device " + spec + " needs a dest")
+		return device
+
 	def size_str_to_bytes(self, string):
 		"""Take in a size argument (20M, 1.5T, etc.) and return number of bytes (IEC)"""
 		if re.match('\d', string[-1]) is None:
@@ -72,8 +175,154 @@ class Config:
 		return "Config {" + ', '.join("%s: %s" % item for item in vars(self).items()) + "}"
 
 
+class Stats:
+	"""Collects how long each phase of a sync took, and counts of the work done
+
+	Phases record wall and cpu time, and can overlap (e.g. playlists are parsed while songs are
+	being added).  Counters are just named numbers, like stat_calls or bytes_parsed.  Both can be
+	updated from any thread.
+	Hooks are called with (kind, name, value) every time something is recorded, where kind is
+	"phase" with a value of (wall, cpu) seconds or "count" with the amount added.  They can be used
+	to send everything to some other timing or metrics system.
+	"""
+
+	def __init__(self):
+		self.phases = {} # name -> [wall, cpu, times entered]
+		self.counters = {} # name -> number
+		self.hooks = []
+		self.lock = threading.Lock()
+
+	def add_hook(self, hook):
+		self.hooks.append(hook)
+
+	def add_time(self, name, wall, cpu, entered=1):
+		with self.lock:
+			phase = self.phases.setdefault(name, [0, 0, 0])
+			phase[0] += wall
+			phase[1] += cpu
+			phase[2] += entered
+		for hook in self.hooks:
+			hook("phase", name, (wall, cpu))
+
+	def count(self, name, amount=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+		for hook in self.hooks:
+			hook("count", name, amount)
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		"""Time the enclosed block as the named phase"""
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		try:
+			yield
+		finally:
+			self.add_time(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+	def time_iter(self, name, iterable):
+		"""Yield from iterable, counting only the time spent getting each item as the named phase"""
+		wall = 0
+		cpu = 0
+		iterator = iter(iterable)
+		try:
+			while True:
+				wall_start = time.perf_counter()
+				cpu_start = time.process_time()
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+				finally:
+					wall += time.perf_counter() - wall_start
+					cpu += time.process_time() - cpu_start
+				yield item
+		finally:
+			self.add_time(name, wall, cpu)
+
+	def to_dict(self):
+		with self.lock:
+			return {
+				"phases": {name: {"wall": wall, "cpu": cpu, "entered": entered}
+				           for name, (wall, cpu, entered) in self.phases.items()},
+				"counters": dict(self.counters),
+			}
+
+	def report(self, format="text"):
+		"""Return a report of everything recorded so far as text or json"""
+		data = self.to_dict()
+		if format == "json":
+			return json.dumps(data, indent=2, sort_keys=True)
+		lines = ["Phase                      wall (s)    cpu (s)"]
+		for name, phase in data["phases"].items():
+			lines.append("%-24s %10.3f %10.3f" % (name, phase["wall"], phase["cpu"]))
+		lines.append("Counter                       value")
+		for name, value in sorted(data["counters"].items()):
+			lines.append("%-24s %12d" % (name, value))
+		return "\n".join(lines)
+
+
+def windows_to_relative_path(windows_path, config):
+	"""Return the path of a song relative to config.source, given its normalized windows path"""
+	source_path = windows_path
+	if config.fb2k_source_mapping is not None:
+		# need to transform e.g. F:\Music\artist\song.mp3 to /media/A/Music/artist/song.mp3
+		mapping = config.fb2k_source_mapping
+		prefix = source_path[:len(mapping)]
+		if not config.case_sensitive:
+			mapping = mapping.lower()
+			prefix = prefix.lower()
+		if prefix != mapping:
+			raise Exception("Song " + source_path + " does not use source mapping")
+		# the path is normalized, so the rest of the path is already exactly what relpath would
+		# give us, apart from a leading separator if the mapping didn't end with one
+		relpath = source_path[len(config.fb2k_source_mapping):].lstrip(ntpath.sep)
+		return relpath.replace(ntpath.sep, os.path.sep)
+	elif not source_path.startswith(config.source):
+		raise Exception("Song " + source_path + " is not within source")
+	return os.path.relpath(source_path, start=config.source)
+
+
+class SongDirectory:
+	"""A directory that songs are in, shared by all of the Songs in it
+
+	Songs only store their file name and point to one of these, so the directory part of their
+	paths is only kept in memory once.
+	"""
+
+	__slots__ = ("config", "relative_path", "songs", "cached_playlist_path", "aliases")
+
+	def __init__(self, config, relative_path):
+		self.config = config
+		self.relative_path = relative_path # relative to config.source, "" for source itself
+		self.songs = {} # file name (lowercased unless config.case_sensitive) -> Song
+		self.cached_playlist_path = None
+		self.aliases = None # file name -> Song that's the same file, only made if there are any
+
+	@property
+	def playlist_path(self):
+		"""The path of this directory after copied to dest, relative to playlist_dest"""
+		if self.cached_playlist_path is None:
+			dest_path = os.path.join(self.config.dest, self.relative_path)
+			self.cached_playlist_path = os.path.relpath(dest_path, start=self.config.playlist_dest)
+		return self.cached_playlist_path
+
+	@property
+	def source_path(self):
+		return os.path.normpath(os.path.join(self.config.source, self.relative_path))
+
+	def __repr__(self):
+		return "SongDirectory at " + self.relative_path
+
+
 class Song:
-	"""Describes a song (which is just some file path)"""
+	"""Describes a song (which is just some file path)
+
+	Only the song's directory and file name are stored; all of the other paths are worked out
+	from them when asked for.
+	"""
+
+	__slots__ = ("directory", "name", "cached_size", "transcoded_path")
 	
 	def __init__(self, windows_path, config):
 		"""Create a song with the given windows path
@@ -81,120 +330,767 @@ class Song:
 		windows_path must be whatever was originally in the fpl file, normalized with abspath
 		ex: ntpath.abspath("F:\Music\Trucker's Atlas.mp3")
 		"""
-		self.windows_path = windows_path
-		self.config = config
+		relative_directory, name = os.path.split(windows_to_relative_path(windows_path, config))
+		self.directory = SongDirectory(config, relative_directory)
+		self.name = name
 		self.cached_size = None
-		
-		# the path to the song in the source directory
-		self.source_path = self.windows_path
-		if config.fb2k_source_mapping is not None:
-			# need to transform e.g. F:\Music\artist\song.mp3 to /media/A/Music/artist/song.mp3
-			if not self.source_path.startswith(config.fb2k_source_mapping):
-				raise Exception("Song " + self.source_path + " does not use source mapping")
-			relpath = ntpath.relpath(self.source_path, start=config.fb2k_source_mapping)
-			relpath = relpath.replace(ntpath.sep, os.path.sep)
-			self.source_path = os.path.join(self.config.source, relpath)
-		elif not self.source_path.startswith(self.config.source):
-			raise Exception("Song " + self.source_path + " is not within source")
-		
-		# the path of the song relative to the source directory
-		self.relative_path = os.path.relpath(self.source_path, start=self.config.source)
-		dest_path = os.path.join(self.config.dest, self.relative_path)
-		# the path of the song after copied to dest, relative to playlist_dest
-		self.playlist_path = os.path.relpath(dest_path, start=self.config.playlist_dest)
+		self.transcoded_path = None # a transcoded copy to transfer instead, see Transcoder
+
+	@classmethod
+	def in_directory(cls, directory, name, key=None):
+		"""Create a song with the given file name in a SongDirectory, adding it to the directory
+
+		key is what the song is kept under in directory.songs, name by default.
+		"""
+		song = cls.__new__(cls)
+		song.directory = directory
+		song.name = name
+		song.cached_size = None
+		song.transcoded_path = None
+		directory.songs[name if key is None else key] = song
+		return song
+
+	@property
+	def config(self):
+		return self.directory.config
+
+	@property
+	def relative_path(self):
+		"""The path of the song relative to the source directory"""
+		return os.path.join(self.directory.relative_path, self.name)
+
+	@property
+	def source_path(self):
+		"""The path to the song in the source directory"""
+		return os.path.join(self.config.source, self.relative_path)
+
+	@property
+	def windows_path(self):
+		"""The path to the song as foobar2000 sees it"""
+		if self.config.fb2k_source_mapping is None:
+			return self.source_path
+		return self.config.fb2k_source_mapping + self.relative_path.replace(os.path.sep, ntpath.sep)
+
+	@property
+	def canonical(self):
+		"""The song to use in place of this one, which is itself unless it's a duplicate
+
+		Songs are marked as duplicates of each other by SongIndex.prefetch_sizes when
+		config.dedupe_inodes is set and they turn out to be the same file.
+		"""
+		aliases = self.directory.aliases
+		if aliases is None:
+			return self
+		return aliases.get(self.name, self)
+
+	@property
+	def transfer_path(self):
+		"""The path to the file that gets copied to dest, which is transcoded_path if there is one"""
+		if self.transcoded_path is None:
+			return self.source_path
+		return self.transcoded_path
+
+	@property
+	def dest_name(self):
+		"""The file name of the song in dest, which has a new extension if it was transcoded"""
+		if self.transcoded_path is None:
+			return self.name
+		return os.path.splitext(self.name)[0] + os.path.splitext(self.transcoded_path)[1]
+
+	@property
+	def dest_relative_path(self):
+		"""The path of the song relative to the dest directory"""
+		return os.path.join(self.directory.relative_path, self.dest_name)
+
+	@property
+	def playlist_path(self):
+		"""The path of the song after copied to dest, relative to playlist_dest"""
+		return os.path.join(self.directory.playlist_path, self.dest_name)
 		
 	def get_size(self):
-		"""Return the size of the song in its source directory"""
+		"""Return the size of the file that will be transferred for this song"""
 		if self.cached_size is None:
-			self.cached_size = os.path.getsize(self.source_path)
+			self.cached_size = os.path.getsize(self.transfer_path)
 		return self.cached_size
 
 	def __repr__(self):
 		return "Song at " + self.windows_path
 
 
+def default_cache_dir():
+	"""Return the directory fplsync caches things in when no other directory is given"""
+	cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(cache_home, "fplsync")
+
+
+class ParseCache:
+	"""Stores the strings parsed out of foobar2000's files so unchanged files aren't parsed again
+
+	Each parsed file gets a cache file holding a key line followed by its null-terminated, utf-8
+	encoded strings.  The key is made from the parsed file's size, mtime and a hash of its first
+	and last few KiB, so any save made by foobar2000 invalidates the cached copy.
+	"""
+
+	version = 1
+	hash_span = 64 * 1024 # number of bytes hashed from both ends of the file
+
+	def __init__(self, cache_dir, playlist_source):
+		# playlists directories from different installs can't share cache files
+		source_hash = hashlib.sha1(os.path.abspath(playlist_source).encode('utf-8')).hexdigest()
+		self.directory = os.path.join(cache_dir, "parsed", source_hash[:16])
+		os.makedirs(self.directory, exist_ok=True)
+
+	def cache_path(self, path):
+		return os.path.join(self.directory, os.path.basename(path) + ".cache")
+
+	def file_key(self, path):
+		"""Return the key that the cached copy of the file at path must have to be valid"""
+		with open(path, 'rb') as infile:
+			stat = os.fstat(infile.fileno())
+			digest = hashlib.sha1(infile.read(self.hash_span))
+			if stat.st_size > self.hash_span:
+				infile.seek(max(self.hash_span, stat.st_size - self.hash_span))
+				digest.update(infile.read())
+		key = "fplsync-parse-cache %d %d %d %s" % (self.version, stat.st_size, stat.st_mtime_ns,
+		                                            digest.hexdigest())
+		return key.encode('utf-8')
+
+	def lookup(self, path):
+		"""Return (key, strings) for the file at path
+
+		strings is an iterator over the cached strings, or None if there is no valid cached copy.
+		Either way, key should be passed to store if the file has to be parsed again.
+		"""
+		key = self.file_key(path)
+		try:
+			with open(self.cache_path(path), 'rb') as infile:
+				if infile.readline() != key + b'\n':
+					return key, None
+		except FileNotFoundError:
+			return key, None
+		return key, self.iter_cached(self.cache_path(path), len(key) + 1)
+
+	def iter_cached(self, cache_path, offset):
+		with open(cache_path, 'rb') as infile:
+			if os.fstat(infile.fileno()).st_size == offset:
+				return # cached file had no strings in it
+			with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+				start = offset
+				end = data.find(b'\x00', start)
+				while end != -1:
+					yield data[start:end].decode('utf-8')
+					start = end + 1
+					end = data.find(b'\x00', start)
+
+	def store(self, path, key, strings):
+		"""Pass through the given strings parsed from the file at path, caching them as they go by
+
+		The cache file only replaces the old one if strings is exhausted, so a partially consumed
+		file never ends up in the cache.
+		"""
+		final_path = self.cache_path(path)
+		temp_path = final_path + "." + str(os.getpid()) + ".tmp"
+		complete = False
+		try:
+			with open(temp_path, 'wb') as outfile:
+				outfile.write(key + b'\n')
+				for string in strings:
+					outfile.write(string.encode('utf-8') + b'\x00')
+					yield string
+			complete = True
+		finally:
+			if complete:
+				os.replace(temp_path, final_path)
+			elif os.path.exists(temp_path):
+				os.remove(temp_path)
+
+
+def iter_fpl_paths(fpl):
+	"""Yield the decoded file paths in the fpl playlist at the given path, in order
+
+	The file is memory-mapped and scanned incrementally, so only one path is held at a time no
+	matter how big the playlist is.
+	"""
+	with open(fpl, 'rb') as infile:
+		if os.fstat(infile.fileno()).st_size == 0:
+			return # can't mmap an empty file, and there's nothing in it anyway
+		with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			# FPL entries have file URIs surrounded by null bytes
+			prefix = b'\x00file://'
+			pos = data.find(prefix)
+			while pos != -1:
+				start = pos + len(prefix)
+				end = data.find(b'\x00', start)
+				if end == -1:
+					break # unterminated entry at the end of the file
+				yield data[start:end].decode('utf-8')
+				# the terminating null byte may also start the next entry
+				pos = data.find(prefix, end)
+
+
+def parse_fpl_joined(fpl):
+	"""Return all of the paths in the fpl playlist at the given path joined by null bytes
+
+	One string is much cheaper to send back from another process than a list of them.
+	"""
+	return '\x00'.join(iter_fpl_paths(fpl))
+
+
 class Playlist:
-	"""Holds a list of songs"""
+	"""Holds a list of songs
+
+	Songs are read lazily from the fpl file whenever the playlist is iterated, so a playlist can be
+	consumed without ever holding all of its songs in memory.  The songs attribute is still
+	available, but builds the full list the first time it's accessed.
+	"""
 	
-	def __init__(self, name, fpl, song_index):
+	def __init__(self, name, fpl, song_index, parse_cache=None):
 		"""Create a playlist
 
 		name - the name of the playlist
 		fpl - the path to a fpl playlist
+		parse_cache - optional ParseCache to load the fpl's paths from
 		"""
 		self.name = name
 		self.fpl = fpl
-		self.songs = []
 		self.song_index = song_index
-		
+		self.parse_cache = parse_cache
+		self.materialized_songs = None # list of songs, once the songs attribute has been used
+
+	@property
+	def songs(self):
+		if self.materialized_songs is None:
+			self.materialized_songs = list(self.iter_songs())
+		return self.materialized_songs
+
+	def iter_paths(self):
+		"""Yield the windows path of each entry in the fpl file"""
+		stats = self.song_index.stats
+		key = None
+		if self.parse_cache is not None:
+			key, paths = self.parse_cache.lookup(self.fpl)
+			if paths is not None:
+				print("Loading cached playlist " + self.name + "...")
+				return stats.time_iter("load cached playlists", paths)
 		print("Parsing playlist " + self.name + "...")
-		with open(self.fpl, 'rb') as infile:
-			# FPL entries have file URIs surrounded by null bytes
-			paths = re.findall(b'(?<=\x00file://)[^\x00]*(?=\x00)', infile.read())
-			# decode the paths as utf-8 and create our songs array
-			self.songs = [self.song_index.get_song(path.decode('utf-8')) for path in paths]
+		stats.count("bytes_parsed", os.path.getsize(self.fpl))
+		paths = stats.time_iter("parse playlists", iter_fpl_paths(self.fpl))
+		if self.parse_cache is None:
+			return paths
+		return self.parse_cache.store(self.fpl, key, paths)
+
+	def iter_songs(self):
+		"""Yield a Song for each entry in the fpl file, parsing it as we go"""
+		return self.song_index.get_songs(self.iter_paths())
 	
-	def write(self, path):
-		"""Write this playlist as an m3u8 to path/name.m3u8
-		
+	@property
+	def file_name(self):
+		"""Name of the m3u8 file, sanitized for FAT32 with bad chars replaced with underscores"""
+		return re.sub(r'[\x00-\x1F\x7F*/:<>?\\|+,.;=[\]]', '_', self.name) + ".m3u8"
+
+	def render(self, config=None):
+		"""Return the contents of this playlist as an m3u8 file, encoded as utf-8
+
 		Acts like it is being written to config.playlist_dest with relative paths pointing to
-		config.dest.
-		Name is sanitized for FAT32, bad chars replaced with underscores.
+		config.dest.  config defaults to the one the songs were made with.
 		"""
+		lines = []
+		prefixes = {} # SongDirectory -> its playlist path under config
+		for song in self:
+			song = song.canonical
+			if config is None:
+				lines.append(song.playlist_path)
+				continue
+			prefix = prefixes.get(song.directory)
+			if prefix is None:
+				dest_path = os.path.join(config.dest, song.directory.relative_path)
+				prefix = os.path.relpath(dest_path, start=config.playlist_dest)
+				prefixes[song.directory] = prefix
+			lines.append(os.path.join(prefix, song.dest_name))
+		lines.append("")
+		return "\n".join(lines).encode("utf-8")
+
+	def write(self, path, config=None):
+		"""Write this playlist as an m3u8 to path/file_name, see render"""
 		if not os.path.isdir(path):
 			raise Exception("path must point to a directory")
 		print("Writing playlist " + self.name)
-		sanitized_name = re.sub(r'[\x00-\x1F\x7F*/:<>?\\|+,.;=[\]]', '_', self.name)
-		full_path = os.path.join(path, sanitized_name + ".m3u8")
-		with open(full_path, "w") as outfile:
-			for song in self.songs:
-				print(song.playlist_path, file=outfile)
+		full_path = os.path.join(path, self.file_name)
+		with open(full_path, "wb") as outfile:
+			outfile.write(self.render(config))
 		return full_path
 
 	def __iter__(self):
-		return iter(self.songs)
+		if self.materialized_songs is not None:
+			return iter(self.materialized_songs)
+		return self.iter_songs()
 
 	def __repr__(self):
-		return "Playlist '" + self.name + "' with " + str(len(self.songs)) + " songs"
+		if self.materialized_songs is None:
+			return "Playlist '" + self.name + "'"
+		return "Playlist '" + self.name + "' with " + str(len(self.materialized_songs)) + " songs"
 	
 
+def scan_directory_stats(directory, names, fold_case=False):
+	"""Return a dict of name -> (size, mtime_ns, inode) for the given file names in directory
+
+	Uses a single scandir for the whole directory.  Names that aren't found are left out.
+	With fold_case, files whose names only differ in case from one of names are included too,
+	under their own names.
+	"""
+	if fold_case:
+		names = {name.lower() for name in names}
+	stats = {}
+	try:
+		with os.scandir(directory) as entries:
+			for entry in entries:
+				if (entry.name.lower() if fold_case else entry.name) in names:
+					try:
+						stat = entry.stat()
+					except OSError:
+						continue # e.g. a broken symlink, get_size can complain about it later
+					stats[entry.name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+	except OSError:
+		pass # missing directory, same deal
+	return stats
+
+
+def scan_entries(directory):
+	"""Return (files, subdirectories) in directory
+
+	files is a list of (name, size, mtime_ns) and subdirectories is a list of names.  Symlinks are
+	counted as files and not followed.
+	"""
+	files = []
+	subdirectories = []
+	with os.scandir(directory) as entries:
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				subdirectories.append(entry.name)
+			else:
+				stat = entry.stat(follow_symlinks=False)
+				files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+	return files, subdirectories
+
+
+def scan_tree(root, threads):
+	"""Return a dict of relative path -> (size, mtime_ns) for every file under root
+
+	Each level of the tree is read in parallel with the given number of threads.
+	"""
+	inventory = {}
+	level = [""] # relative paths of the directories to read next
+	with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+		while len(level) > 0:
+			next_level = []
+			results = executor.map(scan_entries, [os.path.join(root, path) for path in level])
+			for relative_directory, (files, subdirectories) in zip(level, results):
+				for name, size, mtime_ns in files:
+					inventory[os.path.join(relative_directory, name)] = (size, mtime_ns)
+				next_level.extend(os.path.join(relative_directory, name) for name in subdirectories)
+			level = next_level
+	return inventory
+
+
+class StatCache:
+	"""Remembers the size, mtime and inode of files in source between runs
+
+	Entries are grouped by directory along with the directory's mtime.  As long as a directory's
+	mtime hasn't changed, no files have been added, removed or replaced in it, so the cached
+	entries can be trusted without touching the files themselves.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.directories = {} # directory -> (mtime_ns, {name -> (size, mtime_ns, inode)})
+		self.changed = set() # directories that need to be written back
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		with sqlite3.connect(self.path) as connection:
+			connection.execute("CREATE TABLE IF NOT EXISTS directories "
+			                   "(path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+			connection.execute("CREATE TABLE IF NOT EXISTS files (directory TEXT, name TEXT, "
+			                   "size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+			                   "PRIMARY KEY (directory, name))")
+			for path, mtime_ns in connection.execute("SELECT path, mtime_ns FROM directories"):
+				self.directories[path] = (mtime_ns, {})
+			for row in connection.execute("SELECT directory, name, size, mtime_ns, inode FROM files"):
+				if row[0] in self.directories:
+					self.directories[row[0]][1][row[1]] = row[2:]
+		connection.close()
+
+	def lookup(self, directory, mtime_ns):
+		"""Return the cached {name -> (size, mtime_ns, inode)} for directory, or None if stale"""
+		cached = self.directories.get(directory)
+		if cached is None or cached[0] != mtime_ns:
+			return None
+		return cached[1]
+
+	def update(self, directory, mtime_ns, stats):
+		"""Record freshly read stats for some of the files in directory"""
+		cached = self.directories.get(directory)
+		if cached is not None and cached[0] == mtime_ns:
+			cached[1].update(stats)
+		else:
+			self.directories[directory] = (mtime_ns, dict(stats))
+		self.changed.add(directory)
+
+	def save(self):
+		"""Write any updated directories back to disk"""
+		if len(self.changed) == 0:
+			return
+		with sqlite3.connect(self.path) as connection:
+			for directory in self.changed:
+				mtime_ns, stats = self.directories[directory]
+				connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)",
+				                   (directory, mtime_ns))
+				connection.execute("DELETE FROM files WHERE directory = ?", (directory,))
+				connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+				                       ((directory, name) + stat for name, stat in stats.items()))
+		connection.close()
+		self.changed.clear()
+
+
+class HashCache:
+	"""Remembers the hashes of files in source between runs, so verifying only has to read dest
+
+	A hash is keyed by the file's path, size and mtime, so it's ignored once the file changes.
+	With no path, hashes are only remembered for as long as the HashCache exists.
+	"""
+
+	def __init__(self, path=None):
+		self.path = path
+		self.hashes = {} # path -> (size, mtime_ns, digest)
+		self.changed = set() # paths that need to be written back
+		if self.path is None:
+			return
+		with sqlite3.connect(self.path) as connection:
+			connection.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, "
+			                   "size INTEGER, mtime_ns INTEGER, digest TEXT)")
+			for row in connection.execute("SELECT path, size, mtime_ns, digest FROM hashes"):
+				self.hashes[row[0]] = row[1:]
+		connection.close()
+
+	def lookup(self, path, stat):
+		"""Return the cached digest of the file at path with the given stat, or None if stale"""
+		cached = self.hashes.get(path)
+		if cached is None or cached[:2] != (stat.st_size, stat.st_mtime_ns):
+			return None
+		return cached[2]
+
+	def update(self, path, stat, digest):
+		self.hashes[path] = (stat.st_size, stat.st_mtime_ns, digest)
+		self.changed.add(path)
+
+	def save(self):
+		"""Write any updated hashes back to disk"""
+		if self.path is None or len(self.changed) == 0:
+			return
+		with sqlite3.connect(self.path) as connection:
+			connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+			                       ((path,) + self.hashes[path] for path in self.changed))
+		connection.close()
+		self.changed.clear()
+
+
 class SongIndex:
 	"""Holds map of windows paths to Songs
 
 	Since the same song can be used many times even among a single playlist, we don't want to create
-	a whole bunch of duplicate paths in memory
+	a whole bunch of duplicate paths in memory.  Songs are kept by directory, so each directory
+	path is only stored once.
 	"""
 	
-	def __init__(self, config):
-		self.songs = {} # windows path -> Song instance
+	def __init__(self, config, stats=None):
+		self.directories = {} # path relative to source -> SongDirectory
+		# directory part of windows paths, exactly as seen in fpl files -> SongDirectory
+		self.windows_directories = {}
 		self.config = config
+		self.stats = Stats() if stats is None else stats
+		self.inodes = {} # (st_dev, st_ino) -> first Song seen with them, if config.dedupe_inodes
+		self.stat_cache = None
+		if self.config.cache_dir is not None:
+			self.stat_cache = StatCache(os.path.join(self.config.cache_dir, "stat-cache.sqlite3"))
+	
+	@property
+	def songs(self):
+		"""A dict of windows path -> Song for every song in the index, built when asked for"""
+		return {song.windows_path: song for directory in self.directories.values()
+		        for song in directory.songs.values()}
+
+	def __len__(self):
+		return sum(len(directory.songs) for directory in self.directories.values())
 	
 	def get_song(self, windows_path):
+		return next(self.get_songs([windows_path]))
+
+	def get_songs(self, windows_paths):
+		"""Yield the Song for each of the given windows paths
+
+		Paths are only normalized and translated once per directory.  After that, songs in the
+		same directory just need a dict lookup on the directory part of their path.
+		Unless config.case_sensitive is set, paths that only differ in case give the same Song,
+		like they do in Windows.  Whichever case is seen first is used until prefetch_sizes
+		matches it to the case of the real file.
+		"""
+		windows_directories = self.windows_directories
+		case_sensitive = self.config.case_sensitive
+		for windows_path in windows_paths:
+			windows_directory, separator, name = windows_path.rpartition(ntpath.sep)
+			directory = windows_directories.get(windows_directory)
+			if directory is None or not self.is_plain_name(name):
+				yield self.translate_song(windows_path)
+				continue
+			key = name if case_sensitive else name.lower()
+			song = directory.songs.get(key)
+			if song is None:
+				song = Song.in_directory(directory, name, key)
+				self.stats.count("songs_indexed")
+			yield song
+
+	def is_plain_name(self, name):
+		"""Return True if normalizing a path won't change this last part of it"""
+		return name not in ("", ntpath.curdir, ntpath.pardir) and ntpath.altsep not in name
+
+	def translate_song(self, windows_path):
+		"""Get the song for windows_path the slow way, remembering its directory for next time"""
 		normalized = ntpath.abspath(windows_path)
-		if not normalized in self.songs:
-			self.songs[normalized] = Song(normalized, self.config)
-		return self.songs[normalized]
+		relative_directory, name = os.path.split(windows_to_relative_path(normalized, self.config))
+		directory_key = relative_directory
+		key = name
+		if not self.config.case_sensitive:
+			directory_key = relative_directory.lower()
+			key = name.lower()
+		directory = self.directories.get(directory_key)
+		if directory is None:
+			directory = SongDirectory(self.config, relative_directory)
+			self.directories[directory_key] = directory
+		windows_directory, separator, windows_name = windows_path.rpartition(ntpath.sep)
+		if self.is_plain_name(windows_name):
+			self.windows_directories[windows_directory] = directory
+		song = directory.songs.get(key)
+		if song is None:
+			song = Song.in_directory(directory, name, key)
+			self.stats.count("songs_indexed")
+		return song
+
+	def forget(self, songs):
+		"""Forget the sizes, transcodes and duplicates found for the given songs
+
+		For when the files may have changed since, like between syncs in --watch.  They're all
+		looked up again by the next prefetch_sizes and Transcoder.transcode, which still skip
+		directories and transcodes that haven't changed.
+		"""
+		songs = set(songs)
+		for song in songs:
+			song.cached_size = None
+			song.transcoded_path = None
+			if song.directory.aliases is not None:
+				song.directory.aliases.pop(song.name, None)
+		self.inodes = {key: song for key, song in self.inodes.items() if song not in songs}
+
+	def prefetch_sizes(self, songs):
+		"""Fill in cached_size for each of the given songs
+
+		Songs are grouped by their source directory so each directory is only read once, and
+		directories are read in parallel with config.threads threads.  If there's a stat cache,
+		directories that haven't changed since the last run aren't read at all.
+		Songs whose files can't be found are skipped, so get_size will raise the usual error for
+		them later.
+		Unless config.case_sensitive is set, songs whose files (or directories) can only be found
+		with a different case are renamed to match them.
+		With config.dedupe_inodes, songs that turn out to be the same file as one seen before
+		(hardlinks, or symlinks to it) are marked as its duplicates, see Song.canonical.
+		"""
+		by_song_directory = {} # SongDirectory -> {file name -> Song}
+		for song in songs:
+			if song.cached_size is None:
+				by_song_directory.setdefault(song.directory, {})[song.name] = song
+		if len(by_song_directory) == 0:
+			return
+		print("Getting sizes of songs in " + str(len(by_song_directory)) + " directories...")
+		with self.stats.phase("prefetch sizes"):
+			with concurrent.futures.ThreadPoolExecutor(self.config.threads) as executor:
+				results = executor.map(self.read_song_directory, by_song_directory.keys(),
+				                       by_song_directory.values())
+				for song_directory, (mtime_ns, stats, fresh) in zip(by_song_directory, results):
+					directory = song_directory.source_path
+					if fresh:
+						self.stat_cache.update(directory, mtime_ns, stats)
+					directory_songs = by_song_directory[song_directory]
+					if not self.config.case_sensitive:
+						directory_songs = self.match_name_case(directory_songs, stats)
+					for name, song in directory_songs.items():
+						if name in stats:
+							song.cached_size = stats[name][0]
+					if self.config.dedupe_inodes:
+						self.find_duplicates(directory, directory_songs, stats)
+			if self.stat_cache is not None:
+				self.stat_cache.save()
+
+	def find_duplicates(self, directory, songs, stats):
+		"""Mark songs in directory that are the same file as an earlier song as its duplicates
+
+		songs is a dict of name -> Song and stats is what stat_directory returned for them.
+		"""
+		try:
+			device = os.stat(directory).st_dev
+		except OSError:
+			return
+		self.stats.count("stat_calls")
+		for name, song in songs.items():
+			if name not in stats:
+				continue
+			first = self.inodes.setdefault((device, stats[name][2]), song)
+			# symlinks to other filesystems could share an inode number with a file here by chance
+			if first is not song and os.path.samefile(first.source_path, song.source_path):
+				if song.directory.aliases is None:
+					song.directory.aliases = {}
+				song.directory.aliases[song.name] = first
+				self.stats.count("duplicate_songs")
+
+	def read_song_directory(self, song_directory, names):
+		"""stat_directory for a SongDirectory
+
+		If none of the names are found and config.case_sensitive isn't set, the case of the
+		directory's path is matched to what's in source and it's read again.
+		"""
+		result = self.stat_directory(song_directory.source_path, names)
+		if (len(result[1]) == 0 and not self.config.case_sensitive and
+		    self.match_directory_case(song_directory)):
+			result = self.stat_directory(song_directory.source_path, names)
+		return result
+
+	def match_directory_case(self, song_directory):
+		"""Fix the case of song_directory's path to match source, return True if it changed
+
+		Parts of the path that exist as they are, or that don't exist in any case, are kept.
+		"""
+		matched = ""
+		for part in song_directory.relative_path.split(os.path.sep):
+			parent = os.path.join(self.config.source, matched)
+			if part != "" and not os.path.isdir(os.path.join(parent, part)):
+				self.stats.count("directories_scanned")
+				try:
+					with os.scandir(parent) as entries:
+						for entry in entries:
+							if entry.name.lower() == part.lower() and entry.is_dir():
+								part = entry.name
+								break
+				except OSError:
+					pass
+			matched = os.path.join(matched, part)
+		if matched == song_directory.relative_path:
+			return False
+		song_directory.relative_path = matched
+		song_directory.cached_playlist_path = None
+		return True
+
+	def match_name_case(self, songs, stats):
+		"""Rename songs that were only found with a different case in stats to match it
+
+		songs is a dict of name -> Song and stats is what stat_directory returned for them.
+		Returns songs keyed by their new names.
+		"""
+		real_names = {} # lowercased name -> name found in stats
+		for name in stats:
+			real_names.setdefault(name.lower(), name)
+		matched = {}
+		for name, song in songs.items():
+			if name not in stats and name.lower() in real_names:
+				song.name = real_names[name.lower()]
+			matched[song.name] = song
+		return matched
+
+	def stat_directory(self, directory, names):
+		"""Return (mtime_ns, stats, fresh) for the given file names in directory
+
+		stats is a dict of name -> (size, mtime_ns, inode), and fresh is True if it was read from
+		the filesystem and should go in the stat cache.  mtime_ns is None when there's no cache.
+		"""
+		mtime_ns = None
+		if self.stat_cache is not None:
+			self.stats.count("stat_calls")
+			try:
+				mtime_ns = os.stat(directory).st_mtime_ns
+			except OSError:
+				return None, {}, False
+			cached = self.stat_cache.lookup(directory, mtime_ns)
+			found = cached
+			if cached is not None and not self.config.case_sensitive:
+				found = {name.lower() for name in cached}
+				names = [name.lower() for name in names]
+			if cached is not None and all(name in found for name in names):
+				return mtime_ns, cached, False
+		stats = scan_directory_stats(directory, names, not self.config.case_sensitive)
+		self.stats.count("directories_scanned")
+		self.stats.count("stat_calls", len(stats))
+		return mtime_ns, stats, self.stat_cache is not None
 
 
 class PlaylistIndex:
 	"""Responsible for getting named playlists from fb2k"""
 	
-	def __init__(self, config):
+	def __init__(self, config, stats=None):
 		"""Construct a PlaylistIndex
 
 		Reads playlist name/path associations from index.dat,
 		which is found in the config.playlist_source directory along with fpl files.
 		config.playlist_source should be something like ~/.foobar2000/playlists
+		stats is a Stats instance to record work in, a new one is made if not given
 		"""
 		self.config = config
+		self.stats = Stats() if stats is None else stats
 		self.fpl_files = {} # name -> fpl path
 		self.playlists = {} # name -> playlist
-		self.song_index = SongIndex(self.config)
-		
-		# parse out the name/path associations
+		self.song_index = SongIndex(self.config, self.stats)
+		self.parse_cache = None
+		if self.config.cache_dir is not None:
+			self.parse_cache = ParseCache(self.config.cache_dir, self.config.playlist_source)
+		self.read_index()
+
+	def read_index(self):
+		"""Read the playlist name/path associations from index.dat into fpl_files"""
 		indexpath = os.path.join(self.config.playlist_source, "index.dat")
+		fpl_files = {}
+		with self.stats.phase("read index"):
+			if self.parse_cache is None:
+				entries = self.iter_index_entries(indexpath)
+			else:
+				# the cache stores flat lists of strings, so names and fpl paths alternate
+				key, strings = self.parse_cache.lookup(indexpath)
+				if strings is None:
+					flattened = (string for entry in self.iter_index_entries(indexpath)
+					             for string in entry)
+					strings = self.parse_cache.store(indexpath, key, flattened)
+				entries = zip(strings, strings)
+			for name, fpl_path in entries:
+				fpl_files[name] = os.path.join(self.config.playlist_source, fpl_path)
+		self.fpl_files = fpl_files
+
+	def refresh(self, changed_files):
+		"""Forget playlists whose files changed, returning a set of their names
+
+		changed_files are names of files in config.playlist_source, like DirectoryWatcher.wait
+		returns.  If index.dat is among them it's read again, and playlists that were added,
+		removed or moved to another fpl file count as changed too.  The song index is kept, so
+		songs that are still around don't need to be looked up or sized again.
+		"""
+		old_fpl_files = self.fpl_files
+		if "index.dat" in changed_files:
+			self.read_index()
+		changed_paths = {os.path.join(self.config.playlist_source, name) for name in changed_files}
+		changed = {name for name in old_fpl_files.keys() | self.fpl_files.keys()
+		           if old_fpl_files.get(name) != self.fpl_files.get(name)
+		           or self.fpl_files[name] in changed_paths}
+		for name in changed:
+			self.playlists.pop(name, None)
+		return changed
+
+	def iter_index_entries(self, indexpath):
+		"""Parse out the name/path associations in index.dat, yielding (name, fpl_path) tuples"""
 		with open(indexpath, 'rb') as infile:
 			data = infile.read()
+			self.stats.count("bytes_parsed", len(data))
 			# entries have two null bytes, then fpl_path,
 			# then a 16-bit int containing the length of the playlist name,
 			# two null bytes, then the playlist name
@@ -215,18 +1111,263 @@ class PlaylistIndex:
 				if lastpos > len(data) - 1:
 					raise Exception("Error reading index.dat: not enough data for name")
 				name = data[result.end():lastpos].decode('utf-8')
-				self.fpl_files[name] = os.path.join(self.config.playlist_source, fpl_path)
+				yield name, fpl_path
+
+	def load_many(self, names, jobs=None):
+		"""Get the playlists with the given names, parsing them in parallel
+
+		Playlists that need parsing are parsed by a pool of jobs processes (the CPU count by
+		default), then their songs are looked up in the shared song index here, so the returned
+		playlists have their songs materialized.  Playlists that are in the parse cache or already
+		materialized are left alone, and if there's only one to parse it's left to be read lazily
+		like get_playlist does.  Raises KeyError if a playlist does not exist.
+		"""
+		playlists = [self.get_playlist(name) for name in names]
+		to_parse = {} # fpl path -> (cache key, playlists using it)
+		for playlist in playlists:
+			if playlist.materialized_songs is not None or playlist.fpl in to_parse:
+				continue
+			key = None
+			if self.parse_cache is not None:
+				key, cached = self.parse_cache.lookup(playlist.fpl)
+				if cached is not None:
+					cached.close()
+					continue
+			to_parse[playlist.fpl] = key
+		if jobs is None:
+			jobs = os.cpu_count() or 1
+		if len(to_parse) < 2 or jobs < 2:
+			return playlists
+		print("Parsing " + str(len(to_parse)) + " playlists with " +
+		      str(min(jobs, len(to_parse))) + " processes...")
+		paths = {} # fpl path -> list of windows paths
+		with self.stats.phase("parse playlists"):
+			with concurrent.futures.ProcessPoolExecutor(min(jobs, len(to_parse))) as executor:
+				for fpl, joined in zip(to_parse, executor.map(parse_fpl_joined, to_parse)):
+					paths[fpl] = joined.split('\x00') if joined != "" else []
+					self.stats.count("bytes_parsed", os.path.getsize(fpl))
+		for fpl, key in to_parse.items():
+			if self.parse_cache is not None:
+				paths[fpl] = list(self.parse_cache.store(fpl, key, paths[fpl]))
+		for playlist in playlists:
+			if playlist.fpl in paths and playlist.materialized_songs is None:
+				playlist.materialized_songs = list(self.song_index.get_songs(paths[playlist.fpl]))
+		return playlists
 
 	def get_playlist(self, name):
 		"""Get the playlist with the given name, raises KeyError if it does not exist"""
 		if not name in self.playlists:
 			if name in self.fpl_files:
-				self.playlists[name] = Playlist(name, self.fpl_files[name], self.song_index)
+				self.playlists[name] = Playlist(name, self.fpl_files[name], self.song_index,
+				                                self.parse_cache)
 			else:
 				raise KeyError("Playlist " + name + " does not exist")
 		return self.playlists[name]
 
 
+class DirectoryWatcher:
+	"""Waits for files in a directory to change
+
+	Uses inotify through ctypes where it's available, otherwise compares listings of the
+	directory every poll_interval seconds.  inotify doesn't notice changes made from another
+	machine on network filesystems, so use_inotify=False forces polling.
+	"""
+
+	# event masks from sys/inotify.h
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_FROM = 0x40
+	IN_MOVED_TO = 0x80
+	IN_DELETE = 0x200
+	IN_Q_OVERFLOW = 0x4000
+	EVENT_HEADER = "iIII" # wd, mask, cookie, len, followed by len bytes of name
+
+	def __init__(self, directory, poll_interval=2.0, settle_time=0.5, use_inotify=True):
+		"""Start watching directory
+
+		Once something changes, wait() keeps collecting changes until there have been none for
+		settle_time seconds, since saving playlists touches several files one after another.
+		"""
+		self.directory = directory
+		self.poll_interval = poll_interval
+		self.settle_time = settle_time
+		self.inotify_fd = self.start_inotify() if use_inotify else None
+		self.listing = None
+		if self.inotify_fd is None:
+			self.listing = self.list_files()
+
+	def start_inotify(self):
+		"""Return an inotify file descriptor watching directory, None if inotify isn't available"""
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			fd = libc.inotify_init1(os.O_CLOEXEC)
+		except (OSError, AttributeError):
+			return None
+		if fd < 0:
+			return None
+		mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+		if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+			os.close(fd)
+			return None
+		return fd
+
+	def list_files(self):
+		"""Return a dict of name -> (size, mtime_ns) for each file in directory"""
+		listing = {}
+		for entry in os.scandir(self.directory):
+			if entry.is_file():
+				stat = entry.stat()
+				listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+		return listing
+
+	def wait(self, timeout):
+		"""Wait up to timeout seconds for files to change, return a set of the changed names
+
+		The set is empty if nothing changed in time.
+		"""
+		changed = self.read_changes(timeout)
+		while len(changed) > 0:
+			more = self.read_changes(self.settle_time)
+			if len(more) == 0:
+				break
+			changed |= more
+		return changed
+
+	def read_changes(self, timeout):
+		"""Return names of files that changed within timeout seconds, stopping at the first batch"""
+		if self.inotify_fd is None:
+			return self.poll_changes(timeout)
+		if len(select.select([self.inotify_fd], [], [], timeout)[0]) == 0:
+			return set()
+		data = os.read(self.inotify_fd, 64 * 1024)
+		changed = set()
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = struct.unpack_from(self.EVENT_HEADER, data, offset)
+			offset += struct.calcsize(self.EVENT_HEADER)
+			name = os.fsdecode(data[offset:offset + length].rstrip(b"\x00"))
+			offset += length
+			if mask & self.IN_Q_OVERFLOW:
+				# events were lost, so anything could have changed
+				changed.update(os.listdir(self.directory))
+			elif name != "":
+				changed.add(name)
+		return changed
+
+	def poll_changes(self, timeout):
+		"""Like read_changes, but by comparing directory listings"""
+		deadline = time.monotonic() + timeout
+		while True:
+			listing = self.list_files()
+			changed = {name for name in listing.keys() | self.listing.keys()
+			           if listing.get(name) != self.listing.get(name)}
+			self.listing = listing
+			remaining = deadline - time.monotonic()
+			if len(changed) > 0 or remaining <= 0:
+				return changed
+			time.sleep(min(self.poll_interval, remaining))
+
+	def close(self):
+		if self.inotify_fd is not None:
+			os.close(self.inotify_fd)
+			self.inotify_fd = None
+
+
+DEFAULT_TRANSCODE_COMMAND = ("ffmpeg -nostdin -v error -y -i {input} -map 0:a -map_metadata 0"
+                             " -c:a libopus -b:a 128k {output}")
+
+
+class Transcoder:
+	"""Converts songs with one of config.transcode's extensions by running config.transcode_command
+
+	Outputs are kept in a transcode directory in config.cache_dir, named by a hash of the source
+	path, size and mtime and the transcode settings, so a song is only converted again when it or
+	the settings change.  Outputs that are no longer used are never cleaned up.
+	"""
+
+	def __init__(self, config, stats=None):
+		self.config = config
+		self.stats = Stats() if stats is None else stats
+		self.done = set() # songs that have been through transcode, whether it worked or not
+		self.failed = 0 # number of those that failed
+		cache_dir = default_cache_dir() if config.cache_dir is None else config.cache_dir
+		self.output_dir = os.path.join(cache_dir, "transcode")
+		os.makedirs(self.output_dir, exist_ok=True)
+
+	def wants(self, song):
+		"""Return True if song should be transcoded"""
+		return os.path.splitext(song.name)[1].lower() in self.config.transcode
+
+	def output_path(self, song, stat):
+		"""Return where the transcoded copy of song goes, given the stat of its source file"""
+		key = "\x00".join([song.source_path, str(stat.st_size), str(stat.st_mtime_ns),
+		                   self.config.transcode_command, self.config.transcode_ext])
+		return os.path.join(self.output_dir, hashlib.sha1(key.encode("utf-8", "surrogateescape"))
+		                    .hexdigest() + self.config.transcode_ext)
+
+	def assign_outputs(self, songs):
+		"""Set transcoded_path for the songs that need it, without transcoding them yet
+
+		Lets their names in dest be known (e.g. for rendering playlists) before deciding which of
+		them are worth transcoding.  Each of them has to go through transcode before it's sized.
+		"""
+		for song in {song.canonical for song in songs}:
+			if song not in self.done and self.wants(song):
+				song.transcoded_path = self.output_path(song, os.stat(song.source_path))
+				song.cached_size = None
+
+	def transcode(self, songs):
+		"""Transcode the songs that need it, config.transcode_jobs at a time
+
+		Each transcoded song gets its transcoded_path and cached_size set.  Songs that fail to
+		transcode are left with no transcoded_path, so they'll be copied as they are.
+		"""
+		pending = {song.canonical for song in songs}
+		pending = {song for song in pending if song not in self.done and self.wants(song)}
+		self.done.update(pending)
+		if len(pending) == 0:
+			return
+		print("Transcoding " + str(len(pending)) + " songs with " +
+		      str(self.config.transcode_jobs) + " jobs...")
+		failed = 0
+		with self.stats.phase("transcode"):
+			with concurrent.futures.ThreadPoolExecutor(self.config.transcode_jobs) as executor:
+				futures = {executor.submit(self.transcode_song, song): song for song in pending}
+				for future in concurrent.futures.as_completed(futures):
+					song = futures[future]
+					try:
+						song.transcoded_path = future.result()
+					except (OSError, subprocess.CalledProcessError) as e:
+						print("!!! failed to transcode " + song.relative_path + ": " + str(e))
+						song.transcoded_path = None
+						song.cached_size = None
+						failed += 1
+						continue
+					song.cached_size = os.path.getsize(song.transcoded_path)
+		self.failed += failed
+		if failed > 0:
+			print("!!! " + str(failed) + " songs failed to transcode and will be copied as they are")
+
+	def transcode_song(self, song):
+		"""Transcode song unless it already has been, returning the path of the output"""
+		output = self.output_path(song, os.stat(song.source_path))
+		if os.path.exists(output):
+			self.stats.count("transcodes_cached")
+			return output
+		# keep the extension, since encoders usually pick the output format from it
+		temp_output = output[:-len(self.config.transcode_ext)] + ".part" + self.config.transcode_ext
+		args = [arg.format(input=song.source_path, output=temp_output)
+		        for arg in shlex.split(self.config.transcode_command)]
+		print(song.relative_path + "\n", end="")
+		try:
+			subprocess.check_call(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+			os.replace(temp_output, output)
+		finally:
+			if os.path.exists(temp_output):
+				os.remove(temp_output)
+		self.stats.count("songs_transcoded")
+		return output
+
+
 class OutOfSpaceException(Exception):
 	"""Raised when we run out of space on the device"""
 	
@@ -240,27 +1381,614 @@ class OutOfSpaceException(Exception):
 		                 + " bytes")
 
 
+def copy_file_data(infile, outfile, size, chunk_size=8 * 1024 * 1024):
+	"""Copy size bytes from infile to outfile (both binary file objects opened at position 0)
+
+	Lets the kernel do the copy with copy_file_range or sendfile if it can, falling back to plain
+	buffered reads and writes.
+	"""
+	if hasattr(os, "copy_file_range"):
+		try:
+			offset = 0
+			while offset < size:
+				copied = os.copy_file_range(infile.fileno(), outfile.fileno(),
+				                            min(chunk_size, size - offset), offset, offset)
+				if copied == 0:
+					break
+				offset += copied
+			return
+		except OSError:
+			outfile.seek(0)
+			outfile.truncate()
+	if hasattr(os, "sendfile"):
+		try:
+			offset = 0
+			while offset < size:
+				copied = os.sendfile(outfile.fileno(), infile.fileno(), offset,
+				                     min(chunk_size, size - offset))
+				if copied == 0:
+					break
+				offset += copied
+			return
+		except OSError:
+			outfile.seek(0)
+			outfile.truncate()
+	infile.seek(0)
+	shutil.copyfileobj(infile, outfile, chunk_size)
+
+
+def hash_file(path, chunk_size=8 * 1024 * 1024):
+	"""Return (stat, sha1 hex digest) of the file at path
+
+	The file is mapped into memory and hashed in large chunks.  hashlib doesn't hold the GIL while
+	hashing chunks that big, so several threads can hash files at once at the speed of the disk.
+	"""
+	with open(path, 'rb') as infile:
+		stat = os.fstat(infile.fileno())
+		digest = hashlib.sha1()
+		if stat.st_size == 0:
+			return stat, digest.hexdigest() # can't mmap an empty file
+		with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			if hasattr(data, "madvise"):
+				data.madvise(mmap.MADV_SEQUENTIAL)
+			view = memoryview(data)
+			try:
+				for start in range(0, len(view), chunk_size):
+					digest.update(view[start:start + chunk_size])
+			finally:
+				view.release()
+	return stat, digest.hexdigest()
+
+
+LINK_MODES = ("reflink", "hardlink", "auto")
+
+FICLONE = 0x40049409 # from linux/fs.h
+
+
+def copy_file(source_path, dest_path, link=None):
+	"""Copy the file at source_path to dest_path, along with its mtime
+
+	The copy is made next to dest_path and renamed over it once complete, so dest_path is never
+	left half-written.  Symlinks are copied as symlinks.
+	link can be one of LINK_MODES to share data with source_path rather than copying it, which
+	only works on the same filesystem: "reflink" clones the file's data (btrfs, XFS), "hardlink"
+	makes dest_path another name for the same file, and "auto" tries both in that order.
+	If linking doesn't work, the file is copied as usual.
+	Returns how the file ended up being copied: "symlink", "reflink", "hardlink" or "copy".
+	"""
+	temp_path = dest_path + ".fplsync-tmp"
+	for path in [temp_path, temp_path + ".link"]:
+		if os.path.lexists(path):
+			os.remove(path)
+	if os.path.islink(source_path):
+		os.symlink(os.readlink(source_path), temp_path)
+		os.replace(temp_path, dest_path)
+		return "symlink"
+	with open(source_path, 'rb') as infile, open(temp_path, 'wb') as outfile:
+		stat = os.fstat(infile.fileno())
+		how = "copy"
+		if link == "reflink" or link == "auto":
+			try:
+				fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+				how = "reflink"
+			except OSError:
+				pass
+		if how == "copy" and (link == "hardlink" or link == "auto"):
+			try:
+				os.link(source_path, temp_path + ".link")
+				how = "hardlink"
+			except OSError:
+				pass
+		if how == "copy":
+			copy_file_data(infile, outfile, stat.st_size)
+	if how == "hardlink":
+		# a hardlink is the same file, so it already has the right mtime
+		os.replace(temp_path + ".link", temp_path)
+	else:
+		os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+	os.replace(temp_path, dest_path)
+	return how
+
+
+class Manifest:
+	"""List of the files in dest as of the last successful transfer, stored in dest itself
+
+	Lets the next run skip scanning dest.  Entries are stored as null-terminated
+	"size mtime_ns relative_path" strings after a header line holding a hash of them, followed by
+	"d mtime_ns relative_path" entries for every directory the files are in.  The manifest is only
+	trusted if the hash matches, dest's top level contains exactly the entries it expects, the
+	files at the top level and every directory still have the recorded mtime (any file added,
+	removed or renamed in a directory changes its mtime), and a sample of the other listed files
+	still have the recorded size and mtime.
+	"""
+
+	file_name = ".fplsync-manifest"
+	version = 2
+	sample_size = 32 # number of files to check when validating
+
+	def __init__(self, dest):
+		self.dest = dest
+		self.path = os.path.join(dest, self.file_name)
+
+	def read(self):
+		"""Return the inventory (relative path -> (size, mtime_ns)) from the manifest
+
+		Returns None if there is no manifest or it doesn't look right.
+		"""
+		try:
+			with open(self.path, 'rb') as infile:
+				header = infile.readline().split()
+				body = infile.read()
+		except FileNotFoundError:
+			return None
+		if (len(header) != 3 or header[0] != b'fplsync-manifest'
+		    or header[1] != str(self.version).encode('utf-8')
+		    or header[2] != hashlib.sha1(body).hexdigest().encode('utf-8')):
+			return None
+		inventory = {}
+		directories = {}
+		for entry in body.decode('utf-8').split('\x00')[:-1]:
+			size, mtime_ns, relative_path = entry.split(' ', 2)
+			if size == "d":
+				directories[relative_path] = int(mtime_ns)
+			else:
+				inventory[relative_path] = (int(size), int(mtime_ns))
+		if self.is_valid(inventory, directories):
+			return inventory
+		return None
+
+	def directory_mtimes(self, inventory):
+		"""Return relative path -> mtime_ns for every directory in dest holding inventory's files
+
+		dest itself isn't included, since writing the manifest changes its mtime.
+		"""
+		directories = set()
+		for relative_path in inventory:
+			directory = os.path.dirname(relative_path)
+			while directory != "" and directory not in directories:
+				directories.add(directory)
+				directory = os.path.dirname(directory)
+		return {directory: os.stat(os.path.join(self.dest, directory)).st_mtime_ns
+		        for directory in directories}
+
+	def is_valid(self, inventory, directories):
+		"""Check that dest still looks like the given inventory without scanning all of it"""
+		top_level = set(relative_path.split(os.path.sep, 1)[0] for relative_path in inventory)
+		top_level.add(self.file_name)
+		if set(os.listdir(self.dest)) != top_level:
+			return False
+		try:
+			if self.directory_mtimes(inventory) != directories:
+				return False
+		except OSError:
+			return False
+		# dest's own mtime can't be used, so check the files in it directly
+		top_level_files = [relative_path for relative_path in inventory
+		                   if os.path.sep not in relative_path and relative_path != self.file_name]
+		nested = [relative_path for relative_path in inventory if os.path.sep in relative_path]
+		sample = random.sample(nested, min(self.sample_size, len(nested)))
+		for relative_path in top_level_files + sample:
+			try:
+				stat = os.lstat(os.path.join(self.dest, relative_path))
+			except OSError:
+				return False
+			if (stat.st_size, stat.st_mtime_ns) != inventory[relative_path]:
+				return False
+		return True
+
+	def write(self, inventory):
+		body = ''.join("%d %d %s\x00" % (size, mtime_ns, relative_path)
+		               for relative_path, (size, mtime_ns) in inventory.items())
+		body += ''.join("d %d %s\x00" % (mtime_ns, relative_path)
+		                for relative_path, mtime_ns in self.directory_mtimes(inventory).items())
+		body = body.encode('utf-8')
+		header = "fplsync-manifest %d %s\n" % (self.version, hashlib.sha1(body).hexdigest())
+		temp_path = self.path + ".fplsync-tmp"
+		with open(temp_path, 'wb') as outfile:
+			outfile.write(header.encode('utf-8'))
+			outfile.write(body)
+		os.replace(temp_path, self.path)
+
+	def remove(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+
+class Journal:
+	"""The frozen plan of a transfer and the songs in it that are done, stored in dest itself
+
+	Lets an interrupted transfer be resumed without planning again.  The first line holds the
+	plan as JSON, and the dest path of each song is appended as a JSON string on its own line as
+	soon as it's transferred.  The journal is removed once the transfer succeeds.
+	"""
+
+	file_name = ".fplsync-journal"
+	version = 1
+
+	def __init__(self, dest):
+		self.path = os.path.join(dest, self.file_name)
+		self.file = None
+
+	def start(self, songs):
+		"""Write a new journal planning to transfer songs, and open it for recording"""
+		plan = {"version": self.version, "songs": PlannedSong.entries(songs)}
+		temp_path = self.path + ".fplsync-tmp"
+		with open(temp_path, "w", encoding="utf-8") as outfile:
+			outfile.write(json.dumps(plan) + "\n")
+		os.replace(temp_path, self.path)
+		self.open()
+
+	def open(self):
+		"""Open an existing journal for recording more songs"""
+		self.file = open(self.path, "a", encoding="utf-8")
+
+	def record(self, dest_relative_path):
+		"""Record that the song at dest_relative_path has been transferred"""
+		self.file.write(json.dumps(dest_relative_path) + "\n")
+		self.file.flush()
+
+	def read(self):
+		"""Return (planned songs, set of completed dest paths), or None if there's no journal
+
+		Planned songs are PlannedSong instances.  A partly written last line is ignored.
+		"""
+		try:
+			with open(self.path, encoding="utf-8") as infile:
+				lines = infile.read().split("\n")
+		except FileNotFoundError:
+			return None
+		try:
+			plan = json.loads(lines[0])
+		except ValueError:
+			return None
+		if plan.get("version") != self.version:
+			return None
+		completed = set()
+		for line in lines[1:]:
+			try:
+				completed.add(json.loads(line))
+			except ValueError:
+				pass # cut off when the transfer was interrupted
+		return [PlannedSong(*entry) for entry in plan["songs"]], completed
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def remove(self):
+		self.close()
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+
+class PlannedSong:
+	"""A song read back from a Journal or plan file, which stands in for a Song"""
+
+	__slots__ = ("relative_path", "dest_relative_path", "transfer_path", "cached_size",
+	             "transcoded_path")
+
+	def __init__(self, relative_path, dest_relative_path, transfer_path, size, transcoded):
+		self.relative_path = relative_path
+		self.dest_relative_path = dest_relative_path
+		self.transfer_path = transfer_path
+		self.cached_size = size
+		self.transcoded_path = transfer_path if transcoded else None
+
+	@classmethod
+	def entries(cls, songs):
+		"""Return a list for each of songs (Songs or PlannedSongs) to make a PlannedSong from"""
+		return [[song.relative_path, song.dest_relative_path, song.transfer_path, song.get_size(),
+		         song.transcoded_path is not None] for song in songs]
+
+	@property
+	def canonical(self):
+		return self
+
+	def get_size(self):
+		return self.cached_size
+
+	def __eq__(self, other):
+		return (isinstance(other, PlannedSong)
+		        and self.dest_relative_path == other.dest_relative_path)
+
+	def __hash__(self):
+		return hash(self.dest_relative_path)
+
+	def __repr__(self):
+		return "PlannedSong at " + self.dest_relative_path
+
+
+class TransferProgress:
+	"""A progress update from transferring files, as passed to SyncDirector's progress hooks
+
+	stage - "playlists" or "songs"
+	path - the file being transferred, relative to where it's going
+	file_bytes - bytes of that file transferred so far
+	bytes_done - bytes transferred so far in this stage, including file_bytes
+	files_done - number of files finished so far in this stage
+	rate - current speed in bytes per second, or None if unknown
+	eta - seconds until the file is done, or None if unknown
+	elapsed - seconds since the stage started
+	done - True if this is the last update for the file
+	"""
+
+	__slots__ = ("stage", "path", "file_bytes", "bytes_done", "files_done", "rate", "eta",
+	             "elapsed", "done")
+
+	def __init__(self, stage, path, file_bytes, bytes_done, files_done, rate, eta, elapsed, done):
+		self.stage = stage
+		self.path = path
+		self.file_bytes = file_bytes
+		self.bytes_done = bytes_done
+		self.files_done = files_done
+		self.rate = rate
+		self.eta = eta
+		self.elapsed = elapsed
+		self.done = done
+
+	def __repr__(self):
+		return "TransferProgress {" + ", ".join("%s: %s" % (name, getattr(self, name))
+		                                        for name in self.__slots__) + "}"
+
+
+class RsyncProgressParser:
+	"""Turns the output of rsync --progress into TransferProgress updates
+
+	Works with the per-file progress lines of rsync 3.0 and later, which look like
+	"  1,238,320  42%  1.18MB/s    0:00:02" and end with "(xfr#1, to-chk=3/5)" once the file is
+	done.  Other lines are taken to be the name of the next file, unless they're one of rsync's
+	messages about deleting files and such.
+	"""
+
+	progress_re = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+([\d.]+)([kMGT]?B)/s\s+(\d+):(\d+):(\d+)'
+	                         r'(\s+\(xfe?r)?')
+	message_re = re.compile(r'^(sending incremental file list|building file list|deleting |'
+	                        r'created directory |sent \d|total size is |total: |$)')
+	rate_units = {"B": 1, "kB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+
+	def __init__(self, stage):
+		self.stage = stage
+		self.path = None
+		self.completed_bytes = 0 # bytes of files that are finished
+		self.files_done = 0
+		self.start = time.monotonic()
+		self.partial_line = ""
+
+	def feed(self, text):
+		"""Parse the next chunk of output, returning a list of updates"""
+		lines = re.split(r'[\r\n]', self.partial_line + text)
+		self.partial_line = lines.pop()
+		updates = []
+		for line in lines:
+			update = self.parse_line(line)
+			if update is not None:
+				updates.append(update)
+		return updates
+
+	def parse_line(self, line):
+		"""Return a TransferProgress if line is a progress line, otherwise None"""
+		match = self.progress_re.match(line)
+		if match is None:
+			if self.message_re.match(line) is None and not line.endswith("/"):
+				self.path = line
+			return None
+		file_bytes = int(match.group(1).replace(",", ""))
+		rate = int(float(match.group(3)) * self.rate_units[match.group(4)])
+		hours, minutes, seconds = (int(match.group(i)) for i in range(5, 8))
+		done = match.group(8) is not None
+		bytes_done = self.completed_bytes + file_bytes
+		if done:
+			self.completed_bytes = bytes_done
+			self.files_done += 1
+		return TransferProgress(self.stage, self.path, file_bytes, bytes_done, self.files_done, rate,
+		                        hours * 3600 + minutes * 60 + seconds,
+		                        time.monotonic() - self.start, done)
+
+
+class RsyncEngine:
+	"""Transfers songs by running rsync
+
+	By default rsync walks the whole source directory and filters it with include rules.  With
+	config.files_from, rsync is given the exact list of files to transfer instead, and files that
+	don't belong in dest are deleted beforehand from the director's inventory.
+	"""
+
+	def __init__(self, director):
+		self.director = director
+		self.config = director.config
+
+	def sync_songs(self):
+		"""Transfer the director's songs, return True if everything went fine"""
+		if any(song.transcoded_path is not None for song in self.director.songs):
+			return self.sync_staging_tree()
+		# with include rules, completed songs would be deleted along with anything else excluded
+		if self.config.files_from or len(self.director.completed) > 0:
+			return self.sync_file_list()
+		# see http://stackoverflow.com/a/1813972
+		print("Writing include file")
+		self.director.write_include_file()
+		
+		source = self.director.ensure_trailing_slash(self.config.source)
+		dest = self.director.ensure_no_trailing_slash(self.config.dest)
+		
+		# the manifest is protected so it doesn't get deleted along with everything else
+		args = ["rsync", "-mrlt", "--modify-window=1", "--delete-before", "--progress",
+		        "--delete-excluded", "--filter=P /" + Manifest.file_name,
+		        "--filter=P /" + Journal.file_name,
+		        "--include-from=" + self.director.include_file, "--exclude=*", source, dest]
+		if self.config.dry_run:
+			args.insert(1, "--dry-run")
+		try:
+			print("rsyncing songs")
+			self.director.run_rsync(args, "songs")
+		except subprocess.CalledProcessError as e:
+			print("!!! rsync returned " + str(e.returncode) + " while syncing songs")
+			return False
+		return True
+
+	def sync_file_list(self):
+		self.director.delete_from_dest(self.director.find_extraneous_files())
+		print("Writing file list")
+		self.director.write_file_list()
+		
+		source = self.director.ensure_trailing_slash(self.config.source)
+		dest = self.director.ensure_no_trailing_slash(self.config.dest)
+		
+		# --files-from implies --relative and --dirs, so directories get made as needed
+		args = ["rsync", "-lt", "--modify-window=1", "--progress", "--from0",
+		        "--files-from=" + self.director.file_list, source, dest]
+		if self.config.dry_run:
+			args.insert(1, "--dry-run")
+		try:
+			print("rsyncing songs")
+			self.director.run_rsync(args, "songs")
+		except subprocess.CalledProcessError as e:
+			print("!!! rsync returned " + str(e.returncode) + " while syncing songs")
+			return False
+		return True
+
+
+	def sync_staging_tree(self):
+		"""Transfer songs through a tree of symlinks, for when some of them were transcoded"""
+		self.director.delete_from_dest(self.director.find_extraneous_files())
+		print("Writing staging tree")
+		self.director.write_staging_tree()
+		
+		source = self.director.ensure_trailing_slash(self.director.staging_dir)
+		dest = self.director.ensure_no_trailing_slash(self.config.dest)
+		
+		# -L copies the files the links point to rather than the links themselves
+		args = ["rsync", "-rLt", "--modify-window=1", "--progress", source, dest]
+		if self.config.dry_run:
+			args.insert(1, "--dry-run")
+		try:
+			print("rsyncing songs")
+			self.director.run_rsync(args, "songs")
+		except subprocess.CalledProcessError as e:
+			print("!!! rsync returned " + str(e.returncode) + " while syncing songs")
+			return False
+		return True
+
+
+class NativeEngine:
+	"""Transfers songs by copying them directly with a pool of config.threads threads
+
+	Uses the destination inventory the director already has rather than scanning dest again.
+	A song is skipped if dest has a file of the same size whose mtime is within a second of the
+	source's, like rsync's quick check with --modify-window=1.  Everything else in dest is
+	deleted before copying starts, like --delete-before.
+	With config.link set, songs are reflinked or hardlinked rather than copied when SOURCE and
+	DEST are on the same filesystem.
+	"""
+
+	modify_window = 1000000000 # in nanoseconds
+
+	def __init__(self, director):
+		self.director = director
+		self.config = director.config
+		self.link = self.config.link
+		if self.link is not None and not self.config.dry_run and \
+				os.stat(self.config.source).st_dev != os.stat(self.config.dest).st_dev:
+			print("SOURCE and DEST are on different filesystems, copying songs instead of linking")
+			self.link = None
+
+	def sync_songs(self):
+		"""Transfer the director's songs, return True if everything went fine"""
+		self.director.delete_from_dest(self.director.find_extraneous_files())
+		planned = {song.dest_relative_path: song for song in self.director.pending_songs()}
+		
+		print("Copying songs with " + str(self.config.threads) + " threads")
+		copied_count = 0
+		copied_size = 0
+		failed = []
+		start = time.monotonic()
+		with concurrent.futures.ThreadPoolExecutor(self.config.threads) as executor:
+			futures = {executor.submit(self.sync_song, song): song for song in planned.values()}
+			for future in concurrent.futures.as_completed(futures):
+				try:
+					size = future.result()
+				except OSError as e:
+					print("!!! failed to copy " + futures[future].dest_relative_path + ": " + str(e))
+					failed.append(futures[future])
+					continue
+				if size is not None:
+					copied_count += 1
+					copied_size += size
+					self.director.report_progress(TransferProgress(
+						"songs", futures[future].dest_relative_path, size, copied_size, copied_count,
+						None, None, time.monotonic() - start, True))
+		self.director.report_transfer("songs", copied_count, copied_size, time.monotonic() - start)
+		if len(failed) > 0:
+			print("!!! " + str(len(failed)) + " songs failed to copy")
+		return len(failed) == 0
+
+	def is_up_to_date(self, song, stat):
+		"""Return True if the copy of song in dest matches the given stat of its source"""
+		existing = self.director.dest_inventory.get(song.dest_relative_path)
+		if existing is None:
+			return False
+		size, mtime_ns = existing
+		return size == stat.st_size and abs(mtime_ns - stat.st_mtime_ns) <= self.modify_window
+
+	def sync_song(self, song):
+		"""Copy song to dest unless it's already there, returning the bytes copied or None"""
+		stat = os.lstat(song.transfer_path)
+		if self.is_up_to_date(song, stat):
+			return None
+		# one write per line, so lines from different threads don't get mixed together
+		print(song.dest_relative_path + "\n", end="")
+		if not self.config.dry_run:
+			dest_path = os.path.join(self.config.dest, song.dest_relative_path)
+			os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+			how = copy_file(song.transfer_path, dest_path, self.link)
+			if how == "reflink" or how == "hardlink":
+				self.director.stats.count("songs_" + how + "ed")
+		return stat.st_size
+
+
+TRANSFER_ENGINES = {"rsync": RsyncEngine, "native": NativeEngine}
+
+# ways SyncDirector.add_songs can fill up the available space
+FILL_MODES = ("first", "best", "count", "bytes")
+
+# what SyncDirector.verify_songs does with songs whose copy in dest differs from source
+VERIFY_MODES = ("report", "fix")
+
+# with --transcode and "first", songs are transcoded in batches of this many per transcode job
+TRANSCODE_BATCH_JOBS = 4
+
+VECTORIZE_MIN_SONGS = 1024 # add_songs only uses numpy for at least this many songs at once
+
+
 class SyncDirector:
 	"""Responsible for actually moving files around
 
 	Can add playlists to transfer and songs to transfer, then trigger the transfer
 	Both operations will throw an exception upon adding if source files are too big
 	"""
+
+	plan_version = 1 # format of the plan files written by export_plan
 	
-	def __init__(self, config):
+	def __init__(self, config, stats=None):
+		"""Construct a SyncDirector, stats is a Stats instance to record work in (optional)"""
 		config.validate()
 		self.config = config
+		self.stats = Stats() if stats is None else stats
 		self.is_gathering = True # gathering files, transfer hasn't begun
 		self.songs = set() # set of all Songs to transfer
-		# create a temporary directory to hold playlists and rsync include file
+		# create a temporary directory to hold the rsync include file, file list or staging tree
 		self.temp_dir = tempfile.mkdtemp(prefix="fplsync")
 		print("Created temp directory at " + self.temp_dir)
 		self.include_file = os.path.join(self.temp_dir, "include.txt")
-		if self.config.playlist_dest is not None:
-			self.playlist_dir = os.path.join(self.temp_dir, "playlists")
-			os.mkdir(self.playlist_dir)
+		self.file_list = os.path.join(self.temp_dir, "files.txt")
+		self.staging_dir = os.path.join(self.temp_dir, "staging")
+		self.playlist_files = {} # m3u8 file name -> contents, for each playlist to transfer
 		self.is_playlist_added = False
 		self.cumulative_size = 0
+		self.progress_hooks = [] # called with a TransferProgress as files are transferred
+		self.completed = set() # dest paths of songs already transferred, when resuming
+		self.journal = None # the Journal being recorded to during a transfer
 		self.find_max_size()
 	
 	def find_max_size(self):
@@ -274,18 +2002,8 @@ class SyncDirector:
 			total = self.config.total_override
 
 		# anything that doesn't belong in dest is going to be deleted, so we can consider it free
-		space_dirs = [self.config.dest]
-		if self.config.playlist_dest is not None:
-			space_dirs.append(self.config.playlist_dest)
-		# universal_newlines needed for string output rather than bytes
-		output = subprocess.check_output(["du", "-csb"] + space_dirs, universal_newlines=True)
-		free += int(re.search('(\d+)\s+total', output).group(1))
-		# however, empty directories themselves will remain, which take up space
-		empty_dir_path = os.path.join(self.config.dest, str(uuid.uuid4()))
-		os.mkdir(empty_dir_path)
-		empty_size = os.path.getsize(empty_dir_path)
-		os.rmdir(empty_dir_path)
-		free -= empty_size * len(space_dirs)
+		self.scan_destinations()
+		free += self.reclaimable_size
 		
 		self.max_size = free # by default, can only use free space
 		if self.config.min_free is not None:
@@ -300,6 +2018,41 @@ class SyncDirector:
 		if self.max_size < 1024:
 			raise Exception("Not enough free space")
 
+	def scan_destinations(self):
+		"""Build an inventory of the files already in dest and playlist_dest
+
+		Sets dest_inventory and playlist_inventory (relative path -> (size, mtime_ns)), and
+		reclaimable_size, the number of bytes in those files.  All of it counts as free space,
+		since songs that stay are charged their full size when they're added.
+		"""
+		with self.stats.phase("scan destination"):
+			self.read_inventories()
+		print("Found " + str(len(self.dest_inventory) + len(self.playlist_inventory))
+		      + " files taking up " + str(self.reclaimable_size) + " bytes")
+
+	def read_inventories(self):
+		self.dest_inventory = None
+		if self.config.use_manifest:
+			self.dest_inventory = Manifest(self.config.dest).read()
+			if self.dest_inventory is None:
+				print("No valid manifest in destination")
+			else:
+				print("Read destination inventory from manifest")
+		if self.dest_inventory is None:
+			print("Scanning destination...")
+			self.dest_inventory = scan_tree(self.config.dest, self.config.threads)
+			self.dest_inventory.pop(Manifest.file_name, None)
+			self.dest_inventory.pop(Journal.file_name, None)
+		self.playlist_inventory = {}
+		self.reclaimable_size = sum(size for size, mtime_ns in self.dest_inventory.values())
+		if self.config.playlist_dest is not None:
+			self.playlist_inventory = scan_tree(self.config.playlist_dest, self.config.threads)
+			# don't count the playlists twice if they're kept inside dest
+			playlist_in_dest = os.path.relpath(self.config.playlist_dest, self.config.dest)
+			if playlist_in_dest.startswith(os.pardir):
+				self.reclaimable_size += sum(size for size, mtime_ns in
+				                             self.playlist_inventory.values())
+
 	def add_playlist(self, playlist):
 		"""Add a playlist, which will be transferred to playlist_dest as an m3u8 file.
 		
@@ -310,40 +2063,195 @@ class SyncDirector:
 			raise Exception("Cannot add playlist after transfer begins")
 		if self.config.playlist_dest is None:
 			raise Exception("Cannot add playlist if playlist_dest was not provided")
-		# write to our temp playlist directory
-		path = playlist.write(self.playlist_dir)
-		# make sure adding it doesn't put us over the limit
-		size = os.path.getsize(path)
-		if self.cumulative_size + size > self.max_size:
-			os.remove(path)
+		print("Adding playlist " + playlist.name)
+		contents = playlist.render(self.config)
+		# make sure adding it doesn't put us over the limit.  Adding a playlist again replaces it
+		size = len(contents)
+		added_size = size - len(self.playlist_files.get(playlist.file_name, b""))
+		if self.cumulative_size + added_size > self.max_size:
 			raise OutOfSpaceException(playlist, size)
 		else:
-			self.cumulative_size += size
+			self.cumulative_size += added_size
+		self.playlist_files[playlist.file_name] = contents
 		self.is_playlist_added = True
 	
-	def add_songs(self, songs, randomly=False):
+	def add_songs(self, songs, randomly=False, fill="first"):
 		"""Add the given songs, which will be transferred to dest.
 		
 		songs must be an iterable of Song instances (like a Playlist), or a single Song instance.
-		Adds songs until there wouldn't be enough space to fit one.
-		Once space runs out, OutOfSpaceException is raised, but the successfully added songs remain.
 		If randomly==True, songs are added randomly rather than in the order of the iterable.
+		fill decides what happens when a song doesn't fit:
+		"first" - adds songs until there wouldn't be enough space to fit one.  Once space runs out,
+		          OutOfSpaceException is raised, but the successfully added songs remain.
+		"best" - skips songs that don't fit and keeps trying the rest in order.
+		"count" - adds as many songs as possible, smallest first.
+		"bytes" - uses up as much space as possible, adding the biggest songs that fit first.
+		Except for "first", returns a list of the songs that didn't fit rather than raising.
 		"""
 		if not self.is_gathering:
 			raise Exception("Cannot add songs after transfer begins")
+		if fill not in FILL_MODES:
+			raise ValueError("fill must be one of " + ", ".join(FILL_MODES))
 		if isinstance(songs, Song):
 			songs = [songs]
+		if isinstance(songs, Playlist) and songs.materialized_songs is not None:
+			songs = songs.materialized_songs
+		# "count" has to look at every song anyway, but "first" only vectorizes songs that are
+		# already in memory, so a lazy playlist isn't parsed past the point where space runs out
+		if numpy is not None and (fill == "count" or
+		                          (fill == "first" and isinstance(songs, (list, tuple)))):
+			if not isinstance(songs, (list, tuple)):
+				songs = list(songs)
+			if len(songs) >= VECTORIZE_MIN_SONGS:
+				return self.add_songs_vectorized(songs, randomly, fill)
 		if randomly:
 			songs = list(songs) # shuffling happens in-place, need a copy
 			random.shuffle(songs)
+		if fill == "count" or fill == "bytes":
+			return self.add_songs_sorted(songs, largest_first=(fill == "bytes"))
+		skipped = []
 		for song in songs:
+			song = song.canonical
 			if song not in self.songs: # don't double-count any songs!
+				if song.cached_size is None:
+					self.stats.count("stat_calls")
 				size = song.get_size()
-				if self.cumulative_size + size > self.max_size:
+				if self.cumulative_size + size <= self.max_size:
+					self.accept_song(song, size)
+				elif fill == "first":
 					raise OutOfSpaceException(song, size)
 				else:
-					self.songs.add(song)
-					self.cumulative_size += size
+					skipped.append(song)
+		if fill != "first":
+			return skipped
+
+	def add_songs_sorted(self, songs, largest_first):
+		"""Add songs in order of size, skipping those that don't fit, return the skipped songs
+
+		Going smallest first fits as many songs as possible.  Going largest first and skipping
+		whatever doesn't fit is the usual greedy approximation for using as much space as possible.
+		"""
+		candidates = {} # Song -> size, dicts keep the (possibly shuffled) order for ties
+		for song in songs:
+			song = song.canonical
+			if song not in self.songs and song not in candidates:
+				if song.cached_size is None:
+					self.stats.count("stat_calls")
+				candidates[song] = song.get_size()
+		skipped = []
+		for song in sorted(candidates, key=candidates.get, reverse=largest_first):
+			size = candidates[song]
+			if self.cumulative_size + size <= self.max_size:
+				self.accept_song(song, size)
+			else:
+				skipped.append(song)
+		return skipped
+
+	def add_songs_vectorized(self, songs, randomly, fill):
+		"""add_songs for "first" and "count" with numpy arrays of sizes, giving the same results
+
+		Runs of songs whose sizes are already known are planned with a cumulative sum and a search
+		for where the space runs out, rather than one song at a time.  Sizes that aren't known are
+		still looked up one at a time, so songs after the cutoff are never touched.
+		"""
+		if randomly:
+			# seeded from random, so random.seed still makes the order repeatable
+			order = numpy.random.RandomState(random.getrandbits(32)).permutation(len(songs))
+			songs = [songs[i] for i in order]
+		selected = self.songs
+		candidates = [song for song in dict.fromkeys(song.canonical for song in songs)
+		              if song not in selected]
+		if fill == "count":
+			self.stats.count("stat_calls", sum(1 for song in candidates if song.cached_size is None))
+			sizes = numpy.fromiter((song.get_size() for song in candidates), numpy.int64,
+			                       len(candidates))
+			# a stable sort keeps the order of songs with the same size, like sorted does
+			order = sizes.argsort(kind="mergesort")
+			candidates = [candidates[i] for i in order]
+			sizes = sizes[order]
+			# smallest first, so once one song doesn't fit none of the rest do either
+			fit = self.count_fitting(sizes)
+			self.accept_songs(candidates[:fit], sizes[:fit])
+			return candidates[fit:]
+		sizes = numpy.fromiter((-1 if song.cached_size is None else song.cached_size
+		                        for song in candidates), numpy.int64, len(candidates))
+		start = 0
+		for end in numpy.flatnonzero(sizes < 0).tolist() + [len(candidates)]:
+			if end > start:
+				fit = self.count_fitting(sizes[start:end])
+				self.accept_songs(candidates[start:start + fit], sizes[start:start + fit])
+				if start + fit < end:
+					raise OutOfSpaceException(candidates[start + fit], int(sizes[start + fit]))
+			if end < len(candidates):
+				song = candidates[end]
+				self.stats.count("stat_calls")
+				size = song.get_size()
+				if self.cumulative_size + size > self.max_size:
+					raise OutOfSpaceException(song, size)
+				self.accept_song(song, size)
+			start = end + 1
+
+	def count_fitting(self, sizes):
+		"""Return how many songs with the given numpy array of sizes fit, taken in order"""
+		if len(sizes) == 0:
+			return 0
+		return int(numpy.searchsorted(numpy.cumsum(sizes), self.max_size - self.cumulative_size,
+		                              side="right"))
+
+	def accept_songs(self, songs, sizes):
+		"""Like accept_song for a list of songs and a numpy array of their sizes"""
+		if len(songs) == 0:
+			return
+		total = int(sizes.sum())
+		self.songs.update(songs)
+		self.cumulative_size += total
+		self.stats.count("songs_planned", len(songs))
+		self.stats.count("bytes_planned", total)
+
+	def accept_song(self, song, size):
+		"""Add song to the transfer, which must have already been checked to fit"""
+		self.songs.add(song)
+		self.cumulative_size += size
+		self.stats.count("songs_planned")
+		self.stats.count("bytes_planned", size)
+
+	def find_extraneous_files(self):
+		"""Return the relative paths of files in dest that aren't part of the plan"""
+		planned = set(song.dest_relative_path for song in self.songs)
+		return [path for path in self.dest_inventory if path not in planned]
+
+	def delete_from_dest(self, relative_paths, root=None):
+		"""Delete the given files from dest, along with any directories they leave empty
+
+		root is the directory the paths are relative to, dest by default.
+		"""
+		if root is None:
+			root = self.config.dest
+		directories = set()
+		for relative_path in relative_paths:
+			print("deleting " + relative_path)
+			if not self.config.dry_run:
+				os.remove(os.path.join(root, relative_path))
+			directory = os.path.dirname(relative_path)
+			while directory != "" and directory not in directories:
+				directories.add(directory)
+				directory = os.path.dirname(directory)
+		if self.config.dry_run:
+			return
+		# deepest first, so parents are empty by the time we get to them
+		for directory in sorted(directories, key=lambda d: d.count(os.path.sep), reverse=True):
+			try:
+				os.rmdir(os.path.join(root, directory))
+			except OSError:
+				pass # still has something in it
+
+	def stat_planned_songs(self):
+		"""Return an inventory (relative path -> (size, mtime_ns)) of the planned songs in dest"""
+		def stat_song(song):
+			stat = os.lstat(os.path.join(self.config.dest, song.dest_relative_path))
+			return song.dest_relative_path, (stat.st_size, stat.st_mtime_ns)
+		with concurrent.futures.ThreadPoolExecutor(self.config.threads) as executor:
+			return dict(executor.map(stat_song, self.songs))
 
 	def ensure_trailing_slash(self, path):
 		path = os.path.normpath(path)
@@ -363,45 +2271,286 @@ class SyncDirector:
 			for song in self.songs:
 				print(os.path.sep + re.sub("([[*?])", r"\\\1", song.relative_path), file=f)
 
+	def pending_songs(self):
+		"""Return the songs that haven't been transferred yet, which is all of them if not resuming"""
+		return [song for song in self.songs if song.dest_relative_path not in self.completed]
+
+	def write_staging_tree(self):
+		"""Make a tree of symlinks in staging_dir laid out like dest, to each song's transfer_path
+
+		rsync can copy from it with -L when songs don't all come from source.
+		"""
+		os.mkdir(self.staging_dir)
+		for song in self.pending_songs():
+			link = os.path.join(self.staging_dir, song.dest_relative_path)
+			os.makedirs(os.path.dirname(link), exist_ok=True)
+			os.symlink(os.path.abspath(song.transfer_path), link)
+
+	def write_file_list(self):
+		"""Write the relative paths of songs left to transfer to file_list, separated by null bytes"""
+		with open(self.file_list, "wb") as f:
+			for song in self.pending_songs():
+				f.write(song.relative_path.encode('utf-8') + b'\x00')
+
+	def add_progress_hook(self, hook):
+		self.progress_hooks.append(hook)
+
+	def report_progress(self, progress):
+		if progress.done and progress.stage == "songs" and self.journal is not None:
+			self.journal.record(progress.path)
+		for hook in self.progress_hooks:
+			hook(progress)
+
+	def inventory_fingerprint(self):
+		"""Return a hash of what's in dest and playlist_dest, to tell if they changed since"""
+		digest = hashlib.sha1()
+		for inventory in [self.dest_inventory, self.playlist_inventory]:
+			for relative_path, (size, mtime_ns) in sorted(inventory.items()):
+				digest.update(("%d %d %s\x00" % (size, mtime_ns, relative_path)).encode("utf-8"))
+			digest.update(b"\x00")
+		return digest.hexdigest()
+
+	def export_plan(self, path):
+		"""Save everything that has been added to a plan file that apply_plan can transfer later"""
+		plan = {
+			"version": self.plan_version,
+			"dest": os.path.abspath(self.config.dest),
+			"playlist_dest": (None if self.config.playlist_dest is None
+			                  else os.path.abspath(self.config.playlist_dest)),
+			"max_size": self.max_size,
+			"fingerprint": self.inventory_fingerprint(),
+			"playlists": {name: contents.decode("utf-8")
+			              for name, contents in self.playlist_files.items()},
+			"songs": PlannedSong.entries(self.songs),
+		}
+		with open(path, "w", encoding="utf-8") as outfile:
+			json.dump(plan, outfile, separators=(",", ":"))
+		print("Saved plan of " + str(len(self.songs)) + " songs to " + path)
+
+	def apply_plan(self, path):
+		"""Load a plan saved by export_plan, so transfer carries it out without planning again
+
+		Raises an exception if the plan was made for other destinations, or if they have changed
+		since, because then the plan could be wrong about what to delete or what fits.
+		"""
+		if not self.is_gathering:
+			raise Exception("Cannot apply a plan after transfer begins")
+		with open(path, encoding="utf-8") as infile:
+			plan = json.load(infile)
+		if plan.get("version") != self.plan_version:
+			raise Exception("Plan " + path + " was made by an incompatible version")
+		playlist_dest = (None if self.config.playlist_dest is None
+		                 else os.path.abspath(self.config.playlist_dest))
+		if (plan["dest"], plan["playlist_dest"]) != (os.path.abspath(self.config.dest),
+		                                             playlist_dest):
+			raise Exception("Plan " + path + " was made for " + plan["dest"])
+		if plan["fingerprint"] != self.inventory_fingerprint():
+			raise Exception("Destination has changed since plan " + path + " was made")
+		self.songs = set(PlannedSong(*entry) for entry in plan["songs"])
+		self.playlist_files = {name: contents.encode("utf-8")
+		                       for name, contents in plan["playlists"].items()}
+		self.is_playlist_added = len(self.playlist_files) > 0
+		self.cumulative_size = (sum(song.get_size() for song in self.songs) +
+		                        sum(len(contents) for contents in self.playlist_files.values()))
+		if self.cumulative_size > self.max_size:
+			raise Exception("Plan " + path + " no longer fits in the destination")
+		print("Loaded plan of " + str(len(self.songs)) + " songs from " + path)
+
+	def resume(self):
+		"""Plan to finish the transfer that was interrupted, from the journal it left in dest
+
+		Songs the journal says were transferred are skipped without checking them again.
+		"""
+		if not self.is_gathering:
+			raise Exception("Cannot resume after transfer begins")
+		journal = Journal(self.config.dest).read()
+		if journal is None:
+			raise Exception("No transfer to resume in " + self.config.dest)
+		songs, self.completed = journal
+		self.songs = set(songs)
+		self.cumulative_size = sum(song.get_size() for song in self.songs)
+		print("Resuming transfer of " + str(len(self.pending_songs())) + " of " +
+		      str(len(self.songs)) + " songs")
+
+	def report_transfer(self, stage, files, size, seconds):
+		"""Print a summary of a finished transfer stage and count it in stats"""
+		rate = size / seconds if seconds > 0 else 0
+		print("Transferred " + str(files) + " " + stage + " (" + str(size) + " bytes) in " +
+		      "%.1f seconds, %.2f MiB/s" % (seconds, rate / 1024 ** 2))
+		self.stats.count("files_transferred", files)
+		self.stats.count("bytes_transferred", size)
+
+	def run_rsync(self, args, stage):
+		"""Run rsync with args, passing its output through while reporting its progress
+
+		Output is read by another thread and parsed into TransferProgress updates for the
+		progress hooks.  Raises CalledProcessError if rsync fails, like subprocess.check_call.
+		"""
+		parser = RsyncProgressParser(stage)
+		process = subprocess.Popen(args, stdout=subprocess.PIPE)
+
+		def read_output():
+			decoder = codecs.getincrementaldecoder("utf-8")("replace")
+			parsing = True
+			while True:
+				data = os.read(process.stdout.fileno(), 64 * 1024)
+				text = decoder.decode(data, final=len(data) == 0)
+				sys.stdout.write(text)
+				sys.stdout.flush()
+				if parsing:
+					try:
+						for progress in parser.feed(text):
+							self.report_progress(progress)
+					except Exception as e:
+						# keep reading so rsync doesn't block on a full pipe
+						print("!!! stopped reporting rsync progress: " + repr(e))
+						parsing = False
+				if len(data) == 0:
+					return
+
+		reader = threading.Thread(target=read_output)
+		reader.start()
+		returncode = process.wait()
+		reader.join()
+		process.stdout.close()
+		self.report_transfer(stage, parser.files_done, parser.completed_bytes,
+		                     time.monotonic() - parser.start)
+		if returncode != 0:
+			raise subprocess.CalledProcessError(returncode, args)
+
+	def sync_playlists(self):
+		"""Write the added playlists to playlist_dest and delete everything else there
+
+		Playlists whose contents are already there aren't written again, and the others are
+		written to a temp file and renamed into place, so a playlist is never left half written.
+		"""
+		start = time.monotonic()
+		written_count = 0
+		written_size = 0
+		for name, contents in self.playlist_files.items():
+			path = os.path.join(self.config.playlist_dest, name)
+			existing = self.playlist_inventory.get(name)
+			if existing is not None and existing[0] == len(contents):
+				with open(path, "rb") as f:
+					if hashlib.sha1(f.read()).digest() == hashlib.sha1(contents).digest():
+						continue
+			print("Writing playlist " + name)
+			if not self.config.dry_run:
+				temp_path = os.path.join(self.config.playlist_dest, ".fplsync-" + name)
+				with open(temp_path, "wb") as f:
+					f.write(contents)
+				os.replace(temp_path, path)
+			written_count += 1
+			written_size += len(contents)
+			self.report_progress(TransferProgress("playlists", name, len(contents), written_size,
+			                                      written_count, None, None,
+			                                      time.monotonic() - start, True))
+		self.delete_from_dest([path for path in self.playlist_inventory
+		                       if path not in self.playlist_files], self.config.playlist_dest)
+		self.report_transfer("playlists", written_count, written_size, time.monotonic() - start)
+
+	def find_mismatched_songs(self, songs, hash_cache):
+		"""Hash the given songs in source and dest on a thread pool, return the ones that differ
+
+		Source hashes are looked up in and added to hash_cache.
+		"""
+		def hash_song(song):
+			source_path = os.path.abspath(song.transfer_path)
+			stat = os.stat(source_path)
+			source_digest = hash_cache.lookup(source_path, stat)
+			if source_digest is None:
+				stat, source_digest = hash_file(source_path)
+				self.stats.count("bytes_verified", stat.st_size)
+			else:
+				self.stats.count("hashes_cached")
+			dest_stat, dest_digest = hash_file(os.path.join(self.config.dest,
+			                                                song.dest_relative_path))
+			self.stats.count("bytes_verified", dest_stat.st_size)
+			return source_path, stat, source_digest, dest_digest
+
+		mismatched = []
+		with concurrent.futures.ThreadPoolExecutor(self.config.threads) as executor:
+			futures = {executor.submit(hash_song, song): song for song in songs}
+			for future in concurrent.futures.as_completed(futures):
+				song = futures[future]
+				try:
+					source_path, stat, source_digest, dest_digest = future.result()
+				except OSError as e:
+					print("!!! failed to verify " + song.dest_relative_path + ": " + str(e))
+					mismatched.append(song)
+					continue
+				hash_cache.update(source_path, stat, source_digest)
+				if source_digest != dest_digest:
+					print("!!! " + song.dest_relative_path + " in DEST differs from SOURCE")
+					mismatched.append(song)
+		return mismatched
+
+	def verify_songs(self):
+		"""Check that every song in dest matches its source, return the songs that don't
+
+		Both copies are hashed, except that source hashes are kept in config.cache_dir if it's
+		set, so verifying again after an unchanged sync only reads dest.  If config.verify is
+		"fix", songs that differ are copied again and checked once more.
+		"""
+		print("Verifying " + str(len(self.songs)) + " songs with " + str(self.config.threads) +
+		      " threads")
+		start = time.monotonic()
+		hash_cache = HashCache(None if self.config.cache_dir is None else
+		                       os.path.join(self.config.cache_dir, "hash-cache.sqlite3"))
+		try:
+			mismatched = self.find_mismatched_songs(self.songs, hash_cache)
+			if len(mismatched) > 0 and self.config.verify == "fix":
+				print("Copying " + str(len(mismatched)) + " songs again")
+				for song in mismatched:
+					dest_path = os.path.join(self.config.dest, song.dest_relative_path)
+					os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+					copy_file(song.transfer_path, dest_path)
+				mismatched = self.find_mismatched_songs(mismatched, hash_cache)
+		finally:
+			hash_cache.save()
+		print("Verified songs in %.1f seconds" % (time.monotonic() - start))
+		if len(mismatched) > 0:
+			print("!!! " + str(len(mismatched)) + " songs in DEST differ from SOURCE")
+		return mismatched
+
 	def transfer(self):
 		self.is_gathering = False
 		
 		skip_songs = False
 		if self.is_playlist_added:
-			# rsync will behave very differently depending on trailing slashes...
-			source = self.ensure_trailing_slash(self.playlist_dir)
-			dest = self.ensure_no_trailing_slash(self.config.playlist_dest)
-			# size-only is needed to ignore timestamps - remember the source playlists were just
-			# made, so the timestamps will never be the same
-			args = ["rsync", "-mrt", "--delete-before", "--size-only", "--progress", source, dest]
-			if self.config.dry_run:
-				args.insert(1, "--dry-run")
-			# output rsync stuff normally, throw error if return code isn't 0
 			try:
-				print("rsyncing playlists")
-				subprocess.check_call(args)
-			except subprocess.CalledProcessError as e:
-				print("!!! rsync returned " + str(e.returncode) + " while syncing playlists")
+				with self.stats.phase("transfer playlists"):
+					self.sync_playlists()
+			except OSError as e:
+				print("!!! failed to sync playlists: " + str(e))
 				skip_songs = input("Enter Y to continue syncing songs: ") != "Y"
 		
 		if not skip_songs and len(self.songs) > 0:
-			# see http://stackoverflow.com/a/1813972
-			print("Writing include file")
-			self.write_include_file()
-			
-			source = self.ensure_trailing_slash(self.config.source)
-			dest = self.ensure_no_trailing_slash(self.config.dest)
-			
-			args = ["rsync", "-mrlt", "--modify-window=1", "--delete-before", "--progress",
-			        "--delete-excluded", "--include-from=" + self.include_file, "--exclude=*",
-			        source, dest]
-			if self.config.dry_run:
-				args.insert(1, "--dry-run")
+			manifest = Manifest(self.config.dest)
+			if not self.config.dry_run:
+				# if the transfer gets interrupted, the old manifest would be wrong
+				manifest.remove()
+				# but the journal lets it pick up where it left off
+				self.journal = Journal(self.config.dest)
+				if len(self.completed) > 0:
+					self.journal.open()
+				else:
+					self.journal.start(self.songs)
 			try:
-				print("rsyncing songs")
-				subprocess.check_call(args)
-			except subprocess.CalledProcessError as e:
-				print("!!! rsync returned " + str(e.returncode) + " while syncing songs")
+				with self.stats.phase("transfer songs"):
+					success = TRANSFER_ENGINES[self.config.engine](self).sync_songs()
+			finally:
+				if self.journal is not None:
+					self.journal.close()
+			if success and self.journal is not None:
+				self.journal.remove()
+			if success and not self.config.dry_run and self.config.verify is not None:
+				with self.stats.phase("verify songs"):
+					success = len(self.verify_songs()) == 0
+			if success and not self.config.dry_run and self.config.use_manifest:
+				print("Writing manifest")
+				with self.stats.phase("write manifest"):
+					manifest.write(self.stat_planned_songs())
 		
 		# clean up temporary directory we made
 		if self.config.dont_delete_temp:
@@ -412,6 +2561,82 @@ class SyncDirector:
 			print("Deleted temp directory at " + self.temp_dir)
 
 
+class MultiSyncDirector:
+	"""Syncs the same playlists and songs to several destinations at once
+
+	Takes one Config per destination (see Config.for_destination) and keeps a SyncDirector for
+	each, so every destination has its own budget.  Songs and playlists are only parsed and
+	sized once, since all of the directors share them.  Has the same interface as SyncDirector:
+	a destination that runs out of space stops taking songs (or playlists), and
+	OutOfSpaceException is only raised once all of them have run out.
+	"""
+
+	def __init__(self, configs, stats=None):
+		self.stats = Stats() if stats is None else stats
+		self.directors = [SyncDirector(config, self.stats) for config in configs]
+		dests = [os.path.realpath(director.config.dest) for director in self.directors]
+		if len(set(dests)) != len(dests):
+			raise Exception("Destinations must all be different")
+		self.full_of_playlists = set() # directors that ran out of space for playlists
+		self.full_of_songs = set() # directors that ran out of space for songs
+
+	def add_playlist(self, playlist):
+		"""Add a playlist to every destination that has a playlist_dest"""
+		for director in self.directors:
+			if director.config.playlist_dest is None:
+				self.full_of_playlists.add(director)
+		self.add_to_all(self.full_of_playlists, lambda director: director.add_playlist(playlist))
+
+	def add_songs(self, songs, randomly=False, fill="first"):
+		"""Add songs to every destination, see SyncDirector.add_songs
+
+		Except for "first", returns a list of the songs that didn't fit, once for each destination
+		they didn't fit on.
+		"""
+		if isinstance(songs, Song):
+			songs = [songs]
+		# every director goes through the songs, so only parse them once
+		songs = list(songs)
+		if fill != "first":
+			skipped = []
+			for director in self.directors:
+				skipped.extend(director.add_songs(songs, randomly, fill))
+			return skipped
+		self.add_to_all(self.full_of_songs, lambda director: director.add_songs(songs, randomly))
+
+	def add_to_all(self, full, add):
+		"""Call add with each director that isn't in full, adding those that run out of space"""
+		error = None
+		for director in self.directors:
+			if director in full:
+				continue
+			try:
+				add(director)
+			except OutOfSpaceException as e:
+				print(director.config.dest + ": " + str(e))
+				full.add(director)
+				error = e
+		if len(full) == len(self.directors):
+			raise error if error is not None else OutOfSpaceException(None, 0)
+
+	def add_progress_hook(self, hook):
+		for director in self.directors:
+			director.add_progress_hook(hook)
+
+	def resume(self):
+		for director in self.directors:
+			director.resume()
+
+	def transfer(self):
+		"""Transfer to all of the destinations, config.device_jobs at a time"""
+		jobs = min(self.directors[0].config.device_jobs, len(self.directors))
+		with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+			for director in self.directors:
+				print("Transferring to " + director.config.dest)
+			# list() so any exception gets raised here
+			list(executor.map(lambda director: director.transfer(), self.directors))
+
+
 def make_arg_parser(optional_only=False):
 	ap = argparse.ArgumentParser(description="Sync foobar2000 playlists and their songs")
 	ap.add_argument("--playlist-dest", help="if specified, copy PLAYLISTS to this directory as m3u8\
@@ -426,35 +2651,289 @@ def make_arg_parser(optional_only=False):
 	                are short for base 2 units (KiB, MiB, ...).")
 	ap.add_argument("--min-free", help="minimum number of bytes to keep free on the destination.\
 	                See --max-size.")
+	ap.add_argument("--threads", type=int, default=8, help="number of threads to use for\
+	                filesystem work like getting song sizes (default: %(default)s)")
+	ap.add_argument("--engine", choices=sorted(TRANSFER_ENGINES), default="rsync", help="how to\
+	                copy songs to DEST: 'rsync' runs rsync, 'native' copies them directly with\
+	                --threads threads, which can be faster on devices that handle parallel writes\
+	                well (default: %(default)s)")
+	ap.add_argument("--link", choices=LINK_MODES, help="reflink or hardlink songs into DEST\
+	                instead of copying them when it's on the same filesystem as SOURCE, which is\
+	                nearly instant and takes no extra space.  'auto' reflinks if the filesystem\
+	                supports it and hardlinks otherwise.  Implies --engine=native")
+	ap.add_argument("--files-from", action='store_true', help="give rsync the exact list of songs to\
+	                copy rather than filtering all of SOURCE, and delete extraneous files in DEST\
+	                before rsync runs.  Much faster when SOURCE is far bigger than the playlists.")
+	ap.add_argument("--no-manifest", dest="use_manifest", action='store_false', help="don't read or\
+	                write the " + Manifest.file_name + " file in DEST that lets fplsync skip scanning\
+	                DEST when nothing else has touched it since the last sync")
+	ap.add_argument("--fill", choices=FILL_MODES, default="first", help="how to fill DEST: 'first'\
+	                adds songs in order until one doesn't fit, 'best' skips songs that don't fit\
+	                and keeps going, 'count' fits as many songs as possible from all PLAYLISTS,\
+	                'bytes' uses as much space as possible (default: %(default)s)")
+	ap.add_argument("--verify", action='store_const', const="report", help="after transferring,\
+	                hash every song in both SOURCE and DEST and report any that differ.  Hashes of\
+	                SOURCE are kept in --cache-dir if it's given, so later runs only have to read\
+	                DEST")
+	ap.add_argument("--verify-fix", dest="verify", action='store_const', const="fix", help="like\
+	                --verify, but copy songs that differ again")
+	ap.add_argument("--stats", dest="stats_format", action='store_const', const="text",
+	                help="print how long each phase took and counts of the work done at the end")
+	ap.add_argument("--stats-format", dest="stats_format", choices=["text", "json"], help="like\
+	                --stats, but in the given format")
+	ap.add_argument("--device", dest="devices", action='append', default=[], help="also sync to\
+	                another destination, given as comma separated key=value options: dest (required),\
+	                playlist_dest, max_size and min_free, e.g.\
+	                'dest=/media/B/Music,playlist_dest=/media/B/Playlists,max_size=2G'.  Can be given\
+	                more than once.  Playlists are parsed once and songs sized once for all devices.")
+	ap.add_argument("--device-jobs", type=int, default=4, help="number of devices to transfer to at\
+	                the same time (default: %(default)s)")
+	ap.add_argument("--case-sensitive", action='store_true', help="treat paths in playlists that\
+	                differ only in case as different songs.  By default they're the same song, like\
+	                they are to foobar2000 on Windows.")
+	ap.add_argument("--dedupe-inodes", action='store_true', help="copy songs that are hardlinks or\
+	                symlinks to the same file in SOURCE only once, with playlists pointing to the\
+	                one copy")
+	ap.add_argument("--transcode", action='append', default=[], metavar="EXT", help="transcode songs\
+	                with this extension (e.g. flac) before copying them, so more fit in DEST.  Can\
+	                be given more than once.  Transcoded songs are kept in the transcode directory\
+	                of --cache-dir (or " + default_cache_dir() + ") and reused until the song\
+	                or the settings change.  With --fill first, songs are only transcoded until\
+	                DEST is full, but other --fill modes transcode every song in PLAYLISTS.")
+	ap.add_argument("--transcode-ext", default=".opus", help="extension of transcoded songs\
+	                (default: %(default)s)")
+	ap.add_argument("--transcode-command", default=DEFAULT_TRANSCODE_COMMAND, help="command to\
+	                transcode a song with, where {input} and {output} are replaced with paths\
+	                (default: %(default)s)")
+	ap.add_argument("--transcode-jobs", type=int, default=os.cpu_count() or 1, help="number of songs\
+	                to transcode at the same time (default: %(default)s)")
+	ap.add_argument("--resume", action='store_true', help="finish a transfer that was interrupted,\
+	                using the plan it left in DEST and skipping the songs it already transferred.\
+	                PLAYLISTS aren't needed.")
+	ap.add_argument("--export-plan", metavar="FILE", help="save the plan (songs, playlists and a\
+	                fingerprint of DEST) to FILE, e.g. during a --dry-run, so it can be carried out\
+	                later with --apply-plan")
+	ap.add_argument("--apply-plan", metavar="FILE", help="carry out a plan saved with\
+	                --export-plan instead of planning again, as long as DEST hasn't changed since.\
+	                PLAYLISTS aren't needed.")
+	ap.add_argument("--watch", action='store_true', help="keep running, and sync again whenever\
+	                foobar2000 saves PLAYLISTS or a device is mounted at DEST.  A DEST on the\
+	                root filesystem is only synced to if it had files in it at the start, so empty\
+	                mount points are left alone.  Only playlists that changed are parsed again, but song sizes and transcodes\
+	                are checked again before each sync.")
+	ap.add_argument("--watch-interval", type=float, default=2.0, help="seconds between checks for\
+	                DEST appearing, and for changed playlists if inotify isn't available\
+	                (default: %(default)s)")
+	ap.add_argument("--cache-dir", help="cache parsed playlists and song sizes in this directory\
+	                so unchanged ones load quickly next time.  Song sizes are trusted until their\
+	                directory changes, so edits made in place without replacing the file may be\
+	                missed")
+	ap.add_argument("--cache", dest="cache_dir", action='store_const', const=default_cache_dir(),
+	                help="same as --cache-dir " + default_cache_dir())
 	if optional_only:
 		return ap
 	ap.add_argument("playlist_source", metavar="playlist-source",
 	                help="directory containing foobar2000's FPL files")
 	ap.add_argument("source", help="directory where all songs in FPLs are stored under")
 	ap.add_argument("dest", help="directory to copy songs to - ALL EXTRANEOUS FILES DELETED")
-	ap.add_argument("playlists", nargs='+', help="at least one playlist name, for which the\
+	ap.add_argument("playlists", nargs='*', help="at least one playlist name, for which the\
 	                contained songs will be copied into DEST")
 	return ap
 
 
-if __name__ == "__main__":
-	parser = make_arg_parser()
-	# create a Config instance and set its properties according to command line args
-	config = parser.parse_args(namespace=Config())
+def plan_songs(director, playlists, fill, transcoder=None):
+	"""Add songs from the given playlists to director the way the CLI does
 
-	director = SyncDirector(config)
-	index = PlaylistIndex(config)
-	for name in config.playlists:
-		try:
-			director.add_playlist(index.get_playlist(name))
-		except OutOfSpaceException as e:
-			print(e)
-			break
-	for name in config.playlists:
+	Songs are transcoded with transcoder (optional) before they're added.  With "first", that's
+	done a batch at a time, so songs after the point where space runs out are never transcoded.
+	The other modes need to know the size of every song, so they're all transcoded up front.
+	"""
+	if transcoder is not None and fill != "first":
+		transcoder.transcode(song for playlist in playlists for song in playlist)
+		transcoder = None
+	if fill == "first":
+		for playlist in playlists:
+			try:
+				if transcoder is None:
+					director.add_songs(playlist)
+					continue
+				songs = playlist.songs
+				batch_size = TRANSCODE_BATCH_JOBS * transcoder.config.transcode_jobs
+				for start in range(0, len(songs), batch_size):
+					transcoder.transcode(songs[start:start + batch_size])
+					director.add_songs(songs[start:start + batch_size])
+			except OutOfSpaceException as e:
+				print(e)
+				break
+	else:
+		skipped = director.add_songs((song for playlist in playlists for song in playlist),
+		                             fill=fill)
+		if len(skipped) > 0:
+			print(str(len(skipped)) + " songs didn't fit")
+
+
+def add_playlists(director, playlists):
+	"""Add the given playlists to director until one doesn't fit"""
+	for playlist in playlists:
 		try:
-			director.add_songs(index.get_playlist(name))
+			director.add_playlist(playlist)
 		except OutOfSpaceException as e:
 			print(e)
 			break
+
+
+def make_director(configs, stats):
+	"""Return a SyncDirector for a single config, or a MultiSyncDirector for several"""
+	if len(configs) == 1:
+		return SyncDirector(configs[0], stats)
+	return MultiSyncDirector(configs, stats)
+
+
+def sync(configs, index, stats):
+	"""Sync config.playlists from index to each of configs the way the CLI does
+
+	The first config is the main one, the rest are extra devices.  Returns the director used.
+	"""
+	config = configs[0]
+	director = make_director(configs, stats)
+	playlists = index.load_many(config.playlists)
+	# every pass below goes through all the songs, so parse each playlist only once up front.
+	# The songs are kept in the song index anyway
+	songs = [song for playlist in playlists for song in playlist.songs]
+	# sizes first, so duplicates are known before anything gets transcoded or written
+	index.song_index.prefetch_sizes(songs)
+	transcoder = None
+	if len(config.transcode) > 0:
+		# before adding playlists, since transcoded songs get new names.  Songs are only
+		# transcoded once they're being planned
+		transcoder = Transcoder(config, stats)
+		transcoder.assign_outputs(songs)
+	has_playlist_dest = any(config.playlist_dest is not None for config in configs)
+	with stats.phase("add playlists"):
+		add_playlists(director, playlists if has_playlist_dest else [])
+	with stats.phase("plan songs"):
+		plan_songs(director, playlists, config.fill, transcoder)
+	if transcoder is not None and transcoder.failed > 0 and has_playlist_dest:
+		# songs that failed to transcode keep their original names
+		add_playlists(director, playlists)
+	if config.export_plan is not None:
+		director.export_plan(config.export_plan)
 	director.transfer()
+	return director
+
+
+def is_mounted(path):
+	"""Return True if path is on a filesystem mounted at path or one of its parents, besides /"""
+	path = os.path.realpath(path)
+	while path != os.path.dirname(path):
+		if os.path.ismount(path):
+			return True
+		path = os.path.dirname(path)
+	return False
+
+
+def song_set_delta(old_songs, new_songs):
+	"""Return (added, removed) sets of songs going from old_songs to new_songs"""
+	old_songs = set(old_songs)
+	new_songs = set(new_songs)
+	return new_songs - old_songs, old_songs - new_songs
+
 
+def watch(configs, stats):
+	"""Sync whenever config.playlists change or the destinations are mounted, until interrupted
+
+	A destination on the root filesystem counts as mounted only if it already had files in it
+	when watching started, since otherwise it's likely an empty mount point for a device.
+
+	Playlists and the song index stay in memory between syncs, so only changed playlists are
+	parsed again.  Everything else is done again for each sync: song sizes and transcodes are
+	checked, and the songs are planned from scratch against a fresh look at the destinations.
+	The songs added and removed by a playlist change are only printed.
+	"""
+	config = configs[0]
+	index = PlaylistIndex(config, stats)
+	watcher = DirectoryWatcher(config.playlist_source, config.watch_interval)
+	print("Watching " + config.playlist_source + " for changes" +
+	      ("" if watcher.inotify_fd is not None else " by polling"))
+	wanted = set() # songs in the watched playlists
+	changed = set(config.playlists)
+	pending = False # playlists changed since the last sync
+	was_present = False
+	# dest on the root filesystem is either an empty mount point waiting for its device, which
+	# mustn't be synced to, or a fixed destination that already has files in it
+	fixed = {device.dest for device in configs if os.path.isdir(device.dest) and
+	         not is_mounted(device.dest) and len(os.listdir(device.dest)) > 0}
+	for device in configs:
+		if device.dest not in fixed and not is_mounted(device.dest):
+			print("Waiting for a device to be mounted at " + device.dest)
+	try:
+		while True:
+			if len(changed & set(config.playlists)) > 0:
+				try:
+					# keep the songs around so unchanged playlists don't need to be parsed again
+					new_wanted = {song for name in config.playlists
+					              for song in index.get_playlist(name).songs}
+				except KeyError as e:
+					print(e)
+				else:
+					added, removed = song_set_delta(wanted, new_wanted)
+					print("Playlists changed: " + str(len(added)) + " songs added, " +
+					      str(len(removed)) + " removed")
+					wanted = new_wanted
+					pending = True
+			present = all(device.dest in fixed or
+			              (os.path.isdir(device.dest) and is_mounted(device.dest))
+			              for device in configs)
+			if present and (pending or not was_present):
+				# songs may have been retagged or replaced since they were last looked at
+				index.song_index.forget(wanted | {song.canonical for song in wanted})
+				try:
+					sync(configs, index, stats)
+				except Exception as e:
+					print("Sync failed: " + str(e))
+				pending = False
+				if config.stats_format is not None:
+					print(stats.report(config.stats_format))
+			was_present = present
+			changed = index.refresh(watcher.wait(config.watch_interval))
+	finally:
+		watcher.close()
+
+
+if __name__ == "__main__":
+	parser = make_arg_parser()
+	# create a Config instance and set its properties according to command line args
+	config = parser.parse_args(namespace=Config())
+	if len(config.playlists) == 0 and not config.resume and config.apply_plan is None:
+		parser.error("at least one playlist is needed unless resuming or applying a plan")
+	if (config.export_plan is not None or config.apply_plan is not None) and len(config.devices) > 0:
+		parser.error("plans can only be used with a single destination")
+
+	stats = Stats()
+	try:
+		# before anything is built from them, so paths and sizes are normalized everywhere
+		config.validate(require_dest=not config.watch)
+		configs = [config] + [config.for_destination(**config.parse_device(spec))
+		                      for spec in config.devices]
+		for device in configs[1:]:
+			device.validate(require_dest=not config.watch)
+	except (IOError, ValueError, TypeError) as e:
+		parser.error(str(e))
+	if config.watch:
+		try:
+			watch(configs, stats)
+		except KeyboardInterrupt:
+			pass
+	else:
+		if config.resume:
+			director = make_director(configs, stats)
+			director.resume()
+			director.transfer()
+		elif config.apply_plan is not None:
+			director = SyncDirector(config, stats)
+			director.apply_plan(config.apply_plan)
+			director.transfer()
+		else:
+			sync(configs, PlaylistIndex(config, stats), stats)
+		if config.stats_format is not None:
+			print(stats.report(config.stats_format))
@@ -0,0 +1,280 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import unittest
+import fplsync
+import tempfile
+import shutil
+import os
+import sys
+
+def make_fpl(path, windows_paths):
+	"""Write a minimal fpl file containing the given paths"""
+	with open(path, 'wb') as f:
+		f.write(b'\xe1\xa0\x9c\x91\x00\x00junk')
+		for windows_path in windows_paths:
+			f.write(b'\x00file://' + windows_path.encode('utf-8') + b'\x00\x01\x02\x03')
+
+def make_index(playlist_source, names):
+	"""Write an index.dat to playlist_source pointing each name at an fpl file, return the fpls"""
+	fpls = {}
+	with open(os.path.join(playlist_source, "index.dat"), 'wb') as f:
+		f.write(b'\x01\x00\x00\x00')
+		for number, name in enumerate(names):
+			fpl_path = str(number) + ".fpl"
+			encoded = name.encode('utf-8')
+			f.write(b'\x00\x00' + fpl_path.encode('utf-8') + len(encoded).to_bytes(2, sys.byteorder)
+			        + b'\x00\x00' + encoded)
+			fpls[name] = os.path.join(playlist_source, fpl_path)
+		f.write(b'\x00\x00\x00\x00')
+	return fpls
+
+class TestPlaylist(unittest.TestCase):
+
+	def setUp(self):
+		self.temp = tempfile.mkdtemp(prefix="fpltest")
+		self.config = fplsync.Config()
+		self.config.playlist_source = self.temp
+		self.config.source = os.path.join(self.temp, "source")
+		self.config.dest = os.path.join(self.temp, "dest")
+		self.config.playlist_dest = os.path.join(self.temp, "playlists")
+		self.config.fb2k_source_mapping = "F:\\Music"
+		for directory in [self.config.source, self.config.dest, self.config.playlist_dest]:
+			os.mkdir(directory)
+		self.config.validate()
+		self.song_index = fplsync.SongIndex(self.config)
+		self.fpl = os.path.join(self.temp, "1.fpl")
+
+	def tearDown(self):
+		shutil.rmtree(self.temp)
+
+	def test_iter_fpl_paths(self):
+		paths = ["F:\\Music\\a.mp3", "F:\\Music\\b\\\u00fcber.flac", "F:\\Music\\a.mp3"]
+		make_fpl(self.fpl, paths)
+		self.assertEqual(list(fplsync.iter_fpl_paths(self.fpl)), paths)
+
+	def test_empty_fpl(self):
+		make_fpl(self.fpl, [])
+		self.assertEqual(list(fplsync.iter_fpl_paths(self.fpl)), [])
+		open(self.fpl, 'wb').close()
+		self.assertEqual(list(fplsync.iter_fpl_paths(self.fpl)), [])
+
+	def test_unterminated_entry(self):
+		make_fpl(self.fpl, ["F:\\Music\\a.mp3"])
+		with open(self.fpl, 'ab') as f:
+			f.write(b'\x00file://F:\\Music\\b.mp3')
+		self.assertEqual(list(fplsync.iter_fpl_paths(self.fpl)), ["F:\\Music\\a.mp3"])
+
+	def test_lazy_songs(self):
+		make_fpl(self.fpl, ["F:\\Music\\a.mp3", "F:\\Music\\b.mp3"])
+		playlist = fplsync.Playlist("test", self.fpl, self.song_index)
+		self.assertIsNone(playlist.materialized_songs)
+		iterator = iter(playlist)
+		self.assertEqual(next(iterator).relative_path, "a.mp3")
+		self.assertIsNone(playlist.materialized_songs)
+		self.assertEqual([song.relative_path for song in playlist.songs], ["a.mp3", "b.mp3"])
+		# the same Song instances are handed out once materialized
+		self.assertIs(list(playlist)[0], playlist.songs[0])
+
+	def test_parse_cache(self):
+		self.config.cache_dir = os.path.join(self.temp, "cache")
+		self.config.validate()
+		paths = ["F:\\Music\\a.mp3", "F:\\Music\\b.mp3"]
+		make_fpl(self.fpl, paths)
+		cache = fplsync.ParseCache(self.config.cache_dir, self.config.playlist_source)
+		key, cached = cache.lookup(self.fpl)
+		self.assertIsNone(cached)
+
+		# a partially consumed file doesn't get cached
+		stored = cache.store(self.fpl, key, fplsync.iter_fpl_paths(self.fpl))
+		next(stored)
+		stored.close()
+		self.assertIsNone(cache.lookup(self.fpl)[1])
+
+		self.assertEqual(list(cache.store(self.fpl, key, fplsync.iter_fpl_paths(self.fpl))), paths)
+		self.assertEqual(list(cache.lookup(self.fpl)[1]), paths)
+
+		# changing the file invalidates the cached copy
+		make_fpl(self.fpl, paths[:1])
+		self.assertIsNone(cache.lookup(self.fpl)[1])
+
+	def test_playlist_index_cache(self):
+		self.config.cache_dir = os.path.join(self.temp, "cache")
+		self.config.validate()
+		fpls = make_index(self.temp, ["first", "\u00fcber"])
+		make_fpl(fpls["first"], ["F:\\Music\\a.mp3"])
+		for i in range(2): # parse, then load from cache
+			index = fplsync.PlaylistIndex(self.config)
+			self.assertEqual(index.fpl_files, fpls)
+			songs = list(index.get_playlist("first"))
+			self.assertEqual([song.relative_path for song in songs], ["a.mp3"])
+
+	def test_prefetch_sizes(self):
+		os.mkdir(os.path.join(self.config.source, "album"))
+		for relative_path, size in [("a.mp3", 10), (os.path.join("album", "b.mp3"), 20)]:
+			with open(os.path.join(self.config.source, relative_path), "wb") as f:
+				f.write(b"x" * size)
+		songs = [self.song_index.get_song(path) for path in
+		         ["F:\\Music\\a.mp3", "F:\\Music\\album\\b.mp3", "F:\\Music\\missing.mp3"]]
+		self.song_index.prefetch_sizes(songs)
+		self.assertEqual([song.cached_size for song in songs], [10, 20, None])
+		with self.assertRaises(OSError):
+			songs[2].get_size()
+
+	def test_stat_cache(self):
+		self.config.cache_dir = os.path.join(self.temp, "cache")
+		self.config.validate()
+		with open(os.path.join(self.config.source, "a.mp3"), "wb") as f:
+			f.write(b"x" * 10)
+		song_index = fplsync.SongIndex(self.config)
+		song_index.prefetch_sizes([song_index.get_song("F:\\Music\\a.mp3")])
+
+		# a new index reads the cached size without looking at the file
+		song_index = fplsync.SongIndex(self.config)
+		mtime_ns = os.stat(self.config.source).st_mtime_ns
+		self.assertEqual(song_index.stat_cache.lookup(self.config.source, mtime_ns)["a.mp3"][0], 10)
+		song = song_index.get_song("F:\\Music\\a.mp3")
+		self.assertEqual(song_index.stat_directory(self.config.source, {"a.mp3": song})[2], False)
+		song_index.prefetch_sizes([song])
+		self.assertEqual(song.cached_size, 10)
+
+	def test_song_paths(self):
+		song = self.song_index.get_song("F:\\Music\\artist\\album\\01.mp3")
+		self.assertIs(self.song_index.get_song("F:\\Music\\artist\\..\\artist\\album\\01.mp3"), song)
+		self.assertIs(self.song_index.get_song("F:\\Music\\artist\\album\\02.mp3").directory,
+		              song.directory)
+		self.assertEqual(len(self.song_index), 2)
+		# names that normalizing would change don't use the remembered directory
+		self.assertEqual(self.song_index.get_song("F:\\Music\\artist\\album\\..").relative_path,
+		                 "artist")
+		self.assertEqual(self.song_index.get_song("F:\\Music\\artist\\album\\x/y.mp3").relative_path,
+		                 os.path.join("artist", "album", "x", "y.mp3"))
+		self.assertEqual(len(self.song_index), 4)
+		self.assertEqual(song.windows_path, "F:\\Music\\artist\\album\\01.mp3")
+		self.assertEqual(song.relative_path, os.path.join("artist", "album", "01.mp3"))
+		self.assertEqual(song.source_path, os.path.join(self.config.source, song.relative_path))
+		self.assertEqual(song.playlist_path, os.path.join(os.pardir, "dest", song.relative_path))
+		self.assertIs(self.song_index.songs[song.windows_path], song)
+		# songs can still be made on their own
+		self.assertEqual(fplsync.Song(song.windows_path, self.config).playlist_path,
+		                 song.playlist_path)
+
+	def test_refresh(self):
+		fpls = make_index(self.temp, ["first", "second"])
+		make_fpl(fpls["first"], ["F:\\Music\\a.mp3"])
+		make_fpl(fpls["second"], ["F:\\Music\\b.mp3"])
+		index = fplsync.PlaylistIndex(self.config)
+		first, second = index.get_playlist("first"), index.get_playlist("second")
+		a = first.songs[0]
+		self.assertEqual(index.refresh(set()), set())
+
+		make_fpl(fpls["first"], ["F:\\Music\\a.mp3", "F:\\Music\\c.mp3"])
+		self.assertEqual(index.refresh({os.path.basename(fpls["first"])}), {"first"})
+		self.assertIs(index.get_playlist("second"), second)
+		self.assertEqual([song.relative_path for song in index.get_playlist("first")],
+		                 ["a.mp3", "c.mp3"])
+		self.assertIs(index.get_playlist("first").songs[0], a)
+
+		make_index(self.temp, ["second", "third"])
+		self.assertEqual(index.refresh({"index.dat"}), {"first", "second", "third"})
+		with self.assertRaises(KeyError):
+			index.get_playlist("first")
+
+		self.assertEqual(fplsync.song_set_delta([a, second.songs[0]], [a]), (set(), {second.songs[0]}))
+
+	def test_directory_watcher(self):
+		for use_inotify in [False, True]:
+			watcher = fplsync.DirectoryWatcher(self.temp, poll_interval=0.01, settle_time=0.05,
+			                                   use_inotify=use_inotify)
+			try:
+				self.assertEqual(watcher.wait(0.05), set())
+				make_fpl(self.fpl, ["F:\\Music\\a.mp3"] * (2 if use_inotify else 1))
+				self.assertEqual(watcher.wait(1), {"1.fpl"})
+				os.remove(self.fpl)
+				self.assertEqual(watcher.wait(1), {"1.fpl"})
+			finally:
+				watcher.close()
+
+	def test_is_mounted(self):
+		self.assertFalse(fplsync.is_mounted("/"))
+		self.assertTrue(fplsync.is_mounted("/proc/self"))
+
+	def test_case_insensitive(self):
+		song = self.song_index.get_song("F:\\Music\\Artist\\A.mp3")
+		self.assertIs(self.song_index.get_song("f:\\music\\ARTIST\\a.MP3"), song)
+		self.assertIs(self.song_index.get_song("F:\\Music\\Artist\\a.mp3"), song)
+		self.assertEqual(song.relative_path, os.path.join("Artist", "A.mp3"))
+		self.assertEqual(len(self.song_index), 1)
+
+		# the real file only exists as artist/a.mp3, which is what it's called once it's been seen
+		os.mkdir(os.path.join(self.config.source, "artist"))
+		with open(os.path.join(self.config.source, "artist", "a.mp3"), "wb") as f:
+			f.write(b"x" * 10)
+		# (the last time round, the sizes come from the stat cache)
+		for cache_dir in [None] + [os.path.join(self.temp, "cache")] * 2:
+			self.config.cache_dir = cache_dir
+			song_index = fplsync.SongIndex(self.config)
+			song = song_index.get_song("F:\\Music\\Artist\\A.MP3")
+			song_index.prefetch_sizes([song])
+			self.assertEqual((song.relative_path, song.cached_size), (os.path.join("artist", "a.mp3"), 10))
+			self.assertIs(song_index.get_song("F:\\Music\\artist\\a.mp3"), song)
+		self.config.cache_dir = None
+
+		self.config.case_sensitive = True
+		song_index = fplsync.SongIndex(self.config)
+		self.assertIsNot(song_index.get_song("F:\\Music\\Artist\\a.mp3"),
+		                 song_index.get_song("F:\\Music\\Artist\\A.mp3"))
+		self.assertEqual(len(song_index), 2)
+
+	def test_dedupe_inodes(self):
+		self.config.dedupe_inodes = True
+		os.mkdir(os.path.join(self.config.source, "album"))
+		with open(os.path.join(self.config.source, "a.mp3"), "wb") as f:
+			f.write(b"x" * 10)
+		os.link(os.path.join(self.config.source, "a.mp3"),
+		        os.path.join(self.config.source, "album", "hardlink.mp3"))
+		os.symlink(os.path.join(os.pardir, "a.mp3"), os.path.join(self.config.source, "album", "symlink.mp3"))
+		with open(os.path.join(self.config.source, "album", "other.mp3"), "wb") as f:
+			f.write(b"y" * 10)
+		songs = [self.song_index.get_song(path) for path in
+		         ["F:\\Music\\a.mp3", "F:\\Music\\album\\hardlink.mp3", "F:\\Music\\album\\symlink.mp3",
+		          "F:\\Music\\album\\other.mp3"]]
+		self.song_index.prefetch_sizes(songs)
+		self.assertEqual([song.canonical for song in songs], [songs[0], songs[0], songs[0], songs[3]])
+		self.assertEqual(self.song_index.stats.counters["duplicate_songs"], 2)
+
+		# replaced with a different file, like a retagged song
+		os.remove(os.path.join(self.config.source, "album", "hardlink.mp3"))
+		with open(os.path.join(self.config.source, "album", "hardlink.mp3"), "wb") as f:
+			f.write(b"z" * 20)
+		self.song_index.forget(songs)
+		self.song_index.prefetch_sizes(songs)
+		self.assertEqual([song.canonical for song in songs], [songs[0], songs[1], songs[0], songs[3]])
+		self.assertEqual(songs[1].cached_size, 20)
+
+	def test_load_many(self):
+		self.config.cache_dir = os.path.join(self.temp, "cache")
+		self.config.validate()
+		fpls = make_index(self.temp, ["first", "second", "third", "\u00fcber"])
+		make_fpl(fpls["first"], ["F:\\Music\\a.mp3", "F:\\Music\\b.mp3"])
+		make_fpl(fpls["second"], ["F:\\Music\\b.mp3", "F:\\Music\\\u00fcber.flac"])
+		make_fpl(fpls["third"], [])
+		make_fpl(fpls["\u00fcber"], ["F:\\Music\\c.mp3"])
+		index = fplsync.PlaylistIndex(self.config)
+		# already parsed, so it doesn't need to be parsed again
+		index.get_playlist("\u00fcber").songs
+		playlists = index.load_many(["first", "second", "third", "\u00fcber"], jobs=2)
+		self.assertEqual([[song.relative_path for song in playlist.materialized_songs]
+		                  for playlist in playlists],
+		                 [["a.mp3", "b.mp3"], ["b.mp3", "\u00fcber.flac"], [], ["c.mp3"]])
+		# songs are shared through the song index
+		self.assertIs(playlists[0].songs[1], playlists[1].songs[0])
+
+		# now they're all in the parse cache, so they're read lazily from it
+		index = fplsync.PlaylistIndex(self.config)
+		playlists = index.load_many(["first", "second"], jobs=2)
+		self.assertIsNone(playlists[0].materialized_songs)
+		self.assertEqual([song.relative_path for song in playlists[1]], ["b.mp3", "\u00fcber.flac"])
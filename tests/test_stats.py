@@ -0,0 +1,48 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import unittest
+import fplsync
+import json
+
+class TestStats(unittest.TestCase):
+
+	def setUp(self):
+		self.stats = fplsync.Stats()
+		self.events = []
+		self.stats.add_hook(lambda kind, name, value: self.events.append((kind, name)))
+
+	def test_counters(self):
+		self.stats.count("stat_calls")
+		self.stats.count("stat_calls", 4)
+		self.assertEqual(self.stats.counters, {"stat_calls": 5})
+		self.assertEqual(self.events, [("count", "stat_calls")] * 2)
+
+	def test_phases(self):
+		with self.stats.phase("plan"):
+			pass
+		with self.assertRaises(KeyError):
+			with self.stats.phase("plan"):
+				raise KeyError()
+		self.assertEqual(self.stats.phases["plan"][2], 2)
+		self.assertEqual(self.events, [("phase", "plan")] * 2)
+
+	def test_time_iter(self):
+		self.assertEqual(list(self.stats.time_iter("parse", range(3))), [0, 1, 2])
+		# stopping early still records the time
+		iterator = self.stats.time_iter("parse", range(3))
+		next(iterator)
+		iterator.close()
+		self.assertEqual(self.stats.phases["parse"][2], 2)
+
+	def test_report(self):
+		self.stats.count("songs_indexed", 3)
+		with self.stats.phase("plan"):
+			pass
+		self.assertIn("songs_indexed", self.stats.report())
+		data = json.loads(self.stats.report("json"))
+		self.assertEqual(data["counters"], {"songs_indexed": 3})
+		self.assertEqual(list(data["phases"]), ["plan"])
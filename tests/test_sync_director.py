@@ -10,6 +10,7 @@ from copy import copy
 import tempfile
 from contextlib import contextmanager
 import shutil
+import subprocess
 import os
 
 class TestSizeParams(unittest.TestCase):
@@ -115,3 +116,465 @@ class TestSizeParams(unittest.TestCase):
 			sd = fplsync.SyncDirector(self.config)
 			self.assertEqual(sd.max_size, self.config.free_override + 2000)
 
+
+	def test_existing_songs(self):
+		with self.make_mock_fs() as self.config:
+			self.config.free_override = 10000
+			self.config.total_override = 20000
+			self.config.fb2k_source_mapping = "F:\\Music"
+			os.mkdir(os.path.join(self.config.dest, "album"))
+			shutil.copy(os.path.join(self.config.source, "a.mp3"), self.config.dest)
+			shutil.copy(os.path.join(self.config.source, "b.mp3"),
+			            os.path.join(self.config.dest, "album"))
+			sd = fplsync.SyncDirector(self.config)
+			# only files count, not the directories that hold them
+			self.assertEqual(sd.dest_inventory.keys(), {"a.mp3", os.path.join("album", "b.mp3")})
+			self.assertEqual(sd.reclaimable_size, 2000)
+			self.assertEqual(sd.max_size, self.config.free_override + 2000)
+
+			# a song that's already there still costs its size, since its copy counted as free
+			song_index = fplsync.SongIndex(self.config)
+			sd.add_songs([song_index.get_song("F:\\Music\\a.mp3"),
+			              song_index.get_song("F:\\Music\\c.mp3")])
+			self.assertEqual(sd.cumulative_size, 2000)
+
+	def test_native_engine(self):
+		with self.make_mock_fs() as self.config:
+			self.config.free_override = 10000
+			self.config.total_override = 20000
+			self.config.fb2k_source_mapping = "F:\\Music"
+			self.config.engine = "native"
+			os.makedirs(os.path.join(self.config.dest, "old", "album"))
+			with open(os.path.join(self.config.dest, "old", "album", "x.mp3"), "w") as f:
+				print("x", file=f)
+			shutil.copy2(os.path.join(self.config.source, "a.mp3"), self.config.dest)
+			a_inode = os.stat(os.path.join(self.config.dest, "a.mp3")).st_ino
+			
+			sd = fplsync.SyncDirector(self.config)
+			song_index = fplsync.SongIndex(self.config)
+			sd.add_songs([song_index.get_song("F:\\Music\\a.mp3"),
+			              song_index.get_song("F:\\Music\\b.mp3")])
+			sd.transfer()
+			self.assertEqual(sorted(os.listdir(self.config.dest)),
+			                 [fplsync.Manifest.file_name, "a.mp3", "b.mp3"])
+			# a.mp3 was up to date, so it wasn't copied again
+			self.assertEqual(os.stat(os.path.join(self.config.dest, "a.mp3")).st_ino, a_inode)
+			with open(os.path.join(self.config.dest, "b.mp3")) as f:
+				self.assertEqual(f.read(), "b" * 1000)
+			self.assertEqual(os.path.getmtime(os.path.join(self.config.dest, "b.mp3")),
+			                 os.path.getmtime(os.path.join(self.config.source, "b.mp3")))
+
+	def test_manifest(self):
+		with self.make_mock_fs() as self.config:
+			self.config.free_override = 10000
+			self.config.total_override = 20000
+			os.mkdir(os.path.join(self.config.dest, "album"))
+			shutil.copy(os.path.join(self.config.source, "a.mp3"), self.config.dest)
+			shutil.copy(os.path.join(self.config.source, "b.mp3"),
+			            os.path.join(self.config.dest, "album"))
+			manifest = fplsync.Manifest(self.config.dest)
+			self.assertIsNone(manifest.read())
+			inventory = fplsync.scan_tree(self.config.dest, 1)
+			manifest.write(inventory)
+			self.assertEqual(manifest.read(), inventory)
+			sd = fplsync.SyncDirector(self.config)
+			self.assertEqual(sd.dest_inventory, inventory)
+
+			# something else changed dest, so the manifest can't be trusted
+			shutil.copy(os.path.join(self.config.source, "c.mp3"), self.config.dest)
+			self.assertIsNone(manifest.read())
+			sd = fplsync.SyncDirector(self.config)
+			self.assertEqual(len(sd.dest_inventory), 3)
+			os.remove(os.path.join(self.config.dest, "c.mp3"))
+
+			with open(os.path.join(self.config.dest, "album", "b.mp3"), "a") as f:
+				print("b", file=f)
+			self.assertIsNone(manifest.read())
+
+			# files removed deeper in dest are always noticed, not just when they're sampled
+			manifest.sample_size = 0
+			inventory = fplsync.scan_tree(self.config.dest, 1)
+			manifest.write(inventory)
+			self.assertEqual(manifest.read(), inventory)
+			os.remove(os.path.join(self.config.dest, "album", "b.mp3"))
+			self.assertIsNone(manifest.read())
+			# even if something else with the same size and mtime takes its place
+			shutil.copy2(os.path.join(self.config.source, "a.mp3"), self.config.dest)
+			os.rename(os.path.join(self.config.dest, "a.mp3"),
+			          os.path.join(self.config.dest, "album", "b.mp3"))
+			os.utime(os.path.join(self.config.dest, "album", "b.mp3"),
+			         ns=(0, inventory[os.path.join("album", "b.mp3")][1]))
+			self.assertIsNone(manifest.read())
+
+	def test_fill_modes(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.max_size = 2500
+		with open(os.path.join(self.config.source, "big.flac"), "w") as f:
+			print("x" * 2000, file=f, end="")
+		song_index = fplsync.SongIndex(self.config)
+		big, a, b = [song_index.get_song("F:\\Music\\" + name) for name in
+		             ["big.flac", "a.mp3", "b.mp3"]]
+
+		sd = fplsync.SyncDirector(self.config)
+		with self.assertRaises(fplsync.OutOfSpaceException):
+			sd.add_songs([big, a, b])
+		self.assertEqual(sd.songs, {big})
+
+		sd = fplsync.SyncDirector(self.config)
+		self.assertEqual(sd.add_songs([a, big, b], fill="best"), [big])
+		self.assertEqual(sd.songs, {a, b})
+
+		sd = fplsync.SyncDirector(self.config)
+		self.assertEqual(sd.add_songs([big, a, b, a], fill="count"), [big])
+		self.assertEqual(sd.songs, {a, b})
+		self.assertEqual(sd.cumulative_size, 2000)
+
+		self.config.max_size = 3500
+		sd = fplsync.SyncDirector(self.config)
+		self.assertEqual(len(sd.add_songs([a, b, big], fill="bytes")), 1)
+		self.assertEqual(sd.cumulative_size, 3000)
+		self.assertIn(big, sd.songs)
+
+	def test_file_list(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		os.mkdir(os.path.join(self.config.dest, "old"))
+		for path in ["a.mp3", os.path.join("old", "x.mp3")]:
+			shutil.copy(os.path.join(self.config.source, "a.mp3"), os.path.join(self.config.dest, path))
+		sd = fplsync.SyncDirector(self.config)
+		song_index = fplsync.SongIndex(self.config)
+		sd.add_songs([song_index.get_song("F:\\Music\\a.mp3"), song_index.get_song("F:\\Music\\b.mp3")])
+		self.assertEqual(sd.find_extraneous_files(), [os.path.join("old", "x.mp3")])
+		sd.write_file_list()
+		with open(sd.file_list, "rb") as f:
+			self.assertEqual(sorted(f.read().split(b"\x00")), [b"", b"a.mp3", b"b.mp3"])
+		sd.delete_from_dest(sd.find_extraneous_files())
+		self.assertEqual(os.listdir(self.config.dest), ["a.mp3"])
+		shutil.rmtree(sd.temp_dir)
+
+	def test_multiple_destinations(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.max_size = 3500
+		second_dest = os.path.join(os.path.dirname(self.config.dest), "dest2")
+		os.mkdir(second_dest)
+		second = self.config.for_destination(second_dest, max_size=1500)
+		second.free_override = 10000
+		msd = fplsync.MultiSyncDirector([self.config, second])
+		first_sd, second_sd = msd.directors
+		self.assertEqual((first_sd.max_size, second_sd.max_size), (3500, 1500))
+
+		song_index = fplsync.SongIndex(self.config)
+		a, b, c = [song_index.get_song("F:\\Music\\" + name) for name in ["a.mp3", "b.mp3", "c.mp3"]]
+		# the second destination runs out of space, but the first can keep going
+		msd.add_songs([a, b])
+		msd.add_songs([c])
+		self.assertEqual(first_sd.songs, {a, b, c})
+		self.assertEqual(second_sd.songs, {a})
+		with open(os.path.join(self.config.source, "d.mp3"), "w") as f:
+			print("d" * 1000, file=f, end="")
+		with self.assertRaises(fplsync.OutOfSpaceException):
+			msd.add_songs(iter([song_index.get_song("F:\\Music\\d.mp3")]))
+		for sd in msd.directors:
+			shutil.rmtree(sd.temp_dir)
+
+	def test_parse_device(self):
+		device = self.config.parse_device("dest=/media/b,playlist_dest=/media/b/p,max_size=2G")
+		self.assertEqual(device, {"dest": "/media/b", "playlist_dest": "/media/b/p", "max_size": "2G"})
+		with self.assertRaises(ValueError):
+			self.config.parse_device("playlist_dest=/media/b")
+		with self.assertRaises(ValueError):
+			self.config.parse_device("dest=/media/b,colour=blue")
+
+	def test_rsync_progress(self):
+		parser = fplsync.RsyncProgressParser("songs")
+		# rsync 3.1 style, fed in pieces that split lines
+		updates = parser.feed("sending incremental file list\ndeleting old.mp3\nalbum/\nalbum/a.m")
+		self.assertEqual(updates, [])
+		updates = parser.feed("p3\n         32,768   3%    1.00MB/s    0:00:01\r      1,000,000 100%"
+		                      "  953.67kB/s    0:00:00 (xfr#1, to-chk=1/3)\nb.mp3\n")
+		self.assertEqual([(u.path, u.file_bytes, u.bytes_done, u.done) for u in updates],
+		                 [("album/a.mp3", 32768, 32768, False), ("album/a.mp3", 1000000, 1000000, True)])
+		self.assertEqual((updates[0].rate, updates[0].eta), (1024 ** 2, 1))
+		# rsync 3.0 style
+		updates = parser.feed("        500 100%    0.00kB/s    0:00:00 (xfer#2, to-check=0/3)\n"
+		                      "\nsent 1,000,680 bytes  received 54 bytes  2,001,468.00 bytes/sec\n")
+		self.assertEqual([(u.path, u.bytes_done, u.files_done) for u in updates],
+		                 [("b.mp3", 1000500, 2)])
+
+	def test_run_rsync(self):
+		sd = fplsync.SyncDirector(self.config)
+		updates = []
+		sd.add_progress_hook(updates.append)
+		sd.run_rsync(["printf", "a.mp3\\n     1000 100%%    1.00kB/s    0:00:00 (xfr#1, to-chk=0/1)\\n"],
+		             "songs")
+		self.assertEqual([(u.stage, u.path, u.bytes_done) for u in updates], [("songs", "a.mp3", 1000)])
+		self.assertEqual(sd.stats.counters["bytes_transferred"], 1000)
+		with self.assertRaises(subprocess.CalledProcessError):
+			sd.run_rsync(["false"], "songs")
+		shutil.rmtree(sd.temp_dir)
+
+	def test_playlist_sync(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.engine = "native"
+		playlist_source = self.config.playlist_source
+		with open(os.path.join(playlist_source, "1.fpl"), "wb") as f:
+			f.write(b'\x00file://F:\\Music\\a.mp3\x00\x00file://F:\\Music\\b.mp3\x00')
+		for name in ["old.m3u8", "notes.txt"]:
+			with open(os.path.join(self.config.playlist_dest, name), "w") as f:
+				print("x", file=f)
+		playlist = fplsync.Playlist("My: List", os.path.join(playlist_source, "1.fpl"),
+		                            fplsync.SongIndex(self.config))
+		self.assertEqual(playlist.file_name, "My_ List.m3u8")
+		path = os.path.join(self.config.playlist_dest, playlist.file_name)
+
+		sd = fplsync.SyncDirector(self.config)
+		sd.add_playlist(playlist)
+		self.assertEqual(os.listdir(sd.temp_dir), [])
+		sd.transfer()
+		self.assertEqual(os.listdir(self.config.playlist_dest), ["My_ List.m3u8"])
+		with open(path, "rb") as f:
+			self.assertEqual(f.read(), playlist.render(self.config))
+		self.assertEqual(playlist.render(self.config).decode("utf-8").splitlines(),
+		                 [os.path.join("..", "dest", "a.mp3"), os.path.join("..", "dest", "b.mp3")])
+
+		# unchanged playlists aren't written again, but an edit of the same size is noticed
+		sd = fplsync.SyncDirector(self.config)
+		sd.add_playlist(playlist)
+		updates = []
+		sd.add_progress_hook(updates.append)
+		sd.sync_playlists()
+		self.assertEqual(updates, [])
+		with open(path, "r+b") as f:
+			f.write(b"xx")
+		sd.sync_playlists()
+		self.assertEqual([update.path for update in updates], ["My_ List.m3u8"])
+		with open(path, "rb") as f:
+			self.assertEqual(f.read(), playlist.render(self.config))
+		shutil.rmtree(sd.temp_dir)
+
+	def test_transcode(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.engine = "native"
+		self.config.cache_dir = os.path.join(os.path.dirname(self.config.dest), "cache")
+		self.config.transcode = ["MP3"]
+		# a stand-in encoder that keeps the first 100 bytes
+		self.config.transcode_command = "sh -c 'head -c 100 \"$0\" > \"$1\"' {input} {output}"
+		sd = fplsync.SyncDirector(self.config)
+		self.assertEqual(self.config.transcode, [".mp3"])
+		song_index = fplsync.SongIndex(self.config)
+		a, b = song_index.get_song("F:\\Music\\a.mp3"), song_index.get_song("F:\\Music\\b.mp3")
+		stats = fplsync.Stats()
+		fplsync.Transcoder(self.config, stats).transcode([a, b, a])
+		self.assertEqual(stats.counters["songs_transcoded"], 2)
+		self.assertEqual((a.dest_name, a.get_size()), ("a.opus", 100))
+		self.assertTrue(a.transcoded_path.startswith(os.path.join(self.config.cache_dir, "transcode")))
+		self.assertEqual(a.playlist_path, os.path.join("..", "dest", "a.opus"))
+
+		# the cached output is used next time
+		c = fplsync.SongIndex(self.config).get_song("F:\\Music\\a.mp3")
+		fplsync.Transcoder(self.config, stats).transcode([c])
+		self.assertEqual((c.transcoded_path, stats.counters["transcodes_cached"]), (a.transcoded_path, 1))
+
+		sd.add_songs([a, b])
+		self.assertEqual(sd.cumulative_size, 200)
+		sd.write_staging_tree()
+		with open(os.path.join(sd.staging_dir, "b.opus")) as f:
+			self.assertEqual(f.read(), "b" * 100)
+		sd.transfer()
+		self.assertEqual(sorted(os.listdir(self.config.dest)),
+		                 [fplsync.Manifest.file_name, "a.opus", "b.opus"])
+
+		# songs that fail to transcode are copied as they are
+		self.config.transcode_command = "false {input} {output}"
+		d = fplsync.SongIndex(self.config).get_song("F:\\Music\\c.mp3")
+		fplsync.Transcoder(self.config).transcode([d])
+		self.assertEqual((d.transcoded_path, d.dest_name, d.get_size()), (None, "c.mp3", 1000))
+
+	def test_transcode_while_planning(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.cache_dir = os.path.join(os.path.dirname(self.config.dest), "cache")
+		self.config.transcode = [".flac"]
+		self.config.transcode_jobs = 1
+		self.config.transcode_command = "sh -c 'head -c 500 \"$0\" > \"$1\"' {input} {output}"
+		self.config.max_size = 1050
+		paths = []
+		for i in range(10):
+			with open(os.path.join(self.config.source, str(i) + ".flac"), "w") as f:
+				print("x" * 1000, file=f, end="")
+			paths.append("F:\\Music\\" + str(i) + ".flac")
+		with open(os.path.join(self.config.playlist_source, "1.fpl"), "wb") as f:
+			f.write(b''.join(b'\x00file://' + path.encode('utf-8') + b'\x00' for path in paths))
+		song_index = fplsync.SongIndex(self.config)
+		playlist = fplsync.Playlist("list", os.path.join(self.config.playlist_source, "1.fpl"),
+		                            song_index)
+		stats = fplsync.Stats()
+		transcoder = fplsync.Transcoder(self.config, stats)
+		transcoder.assign_outputs(playlist.songs)
+		# names are known before anything is transcoded
+		self.assertEqual(playlist.render().decode("utf-8").split("\n")[:2],
+		                 [os.path.join("..", "dest", "0.opus"), os.path.join("..", "dest", "1.opus")])
+		sd = fplsync.SyncDirector(self.config)
+		fplsync.plan_songs(sd, [playlist], "first", transcoder)
+		self.assertEqual(sd.cumulative_size, 1000)
+		# only the first batch was transcoded, since space ran out in it
+		self.assertEqual(stats.counters["songs_transcoded"], 4)
+		shutil.rmtree(sd.temp_dir)
+
+	def test_resume(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.engine = "native"
+		song_index = fplsync.SongIndex(self.config)
+		sd = fplsync.SyncDirector(self.config)
+		sd.add_songs([song_index.get_song("F:\\Music\\a.mp3"), song_index.get_song("F:\\Music\\b.mp3")])
+		# pretend the transfer was interrupted after copying a.mp3
+		journal = fplsync.Journal(self.config.dest)
+		journal.start(sd.songs)
+		shutil.copy2(os.path.join(self.config.source, "a.mp3"), self.config.dest)
+		journal.record("a.mp3")
+		journal.close()
+		with open(journal.path, "a") as f:
+			f.write('"b.m')
+		a_inode = os.stat(os.path.join(self.config.dest, "a.mp3")).st_ino
+		shutil.rmtree(sd.temp_dir)
+
+		sd = fplsync.SyncDirector(self.config)
+		sd.resume()
+		self.assertEqual(sd.completed, {"a.mp3"})
+		self.assertEqual([song.dest_relative_path for song in sd.pending_songs()], ["b.mp3"])
+		self.assertEqual(sd.cumulative_size, 2000)
+		sd.transfer()
+		self.assertEqual(sorted(os.listdir(self.config.dest)),
+		                 [fplsync.Manifest.file_name, "a.mp3", "b.mp3"])
+		self.assertEqual(os.stat(os.path.join(self.config.dest, "a.mp3")).st_ino, a_inode)
+
+		sd = fplsync.SyncDirector(self.config)
+		with self.assertRaises(Exception):
+			sd.resume()
+		shutil.rmtree(sd.temp_dir)
+
+	@unittest.skipIf(fplsync.numpy is None, "numpy isn't installed")
+	def test_vectorized_add_songs(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.max_size = 2500
+		sizes = [300, 900, 100, 700, 500, 100, 800]
+		for i, size in enumerate(sizes):
+			with open(os.path.join(self.config.source, str(i) + ".mp3"), "w") as f:
+				print("x" * size, file=f, end="")
+		song_index = fplsync.SongIndex(self.config)
+		songs = [song_index.get_song("F:\\Music\\" + str(i) + ".mp3") for i in [0, 1, 0, 2, 3, 4, 5, 6]]
+		songs[1].get_size() # some sizes known up front, the rest looked up as needed
+		results = []
+		for min_songs in [fplsync.VECTORIZE_MIN_SONGS, 1]:
+			original = fplsync.VECTORIZE_MIN_SONGS
+			fplsync.VECTORIZE_MIN_SONGS = min_songs
+			try:
+				sd = fplsync.SyncDirector(self.config)
+				sd.add_songs(songs[:1])
+				with self.assertRaises(fplsync.OutOfSpaceException) as raised:
+					sd.add_songs(songs)
+				first = (set(sd.songs), sd.cumulative_size, raised.exception.failed_object)
+				sd = fplsync.SyncDirector(self.config)
+				skipped = sd.add_songs(songs, fill="count")
+				results.append((first, (set(sd.songs), sd.cumulative_size, skipped)))
+				# modes that can't be vectorized still skip songs that don't fit
+				for fill in ["best", "bytes"]:
+					sd = fplsync.SyncDirector(self.config)
+					skipped = sd.add_songs(songs, fill=fill)
+					results[-1] += ((set(sd.songs), sd.cumulative_size, skipped),)
+				# songs after the one that doesn't fit are never pulled from a lazy iterable
+				consumed = []
+				sd = fplsync.SyncDirector(self.config)
+				with self.assertRaises(fplsync.OutOfSpaceException):
+					sd.add_songs(consumed.append(song) or song for song in songs)
+				self.assertEqual(len(consumed), 7)
+			finally:
+				fplsync.VECTORIZE_MIN_SONGS = original
+		self.assertEqual(results[0], results[1])
+		self.assertEqual(results[0][0][1], 2500)
+
+	def test_plan_file(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.engine = "native"
+		plan_path = os.path.join(os.path.dirname(self.config.dest), "plan.json")
+		with open(os.path.join(self.config.playlist_source, "1.fpl"), "wb") as f:
+			f.write(b'\x00file://F:\\Music\\a.mp3\x00\x00file://F:\\Music\\c.mp3\x00')
+		song_index = fplsync.SongIndex(self.config)
+		playlist = fplsync.Playlist("list", os.path.join(self.config.playlist_source, "1.fpl"),
+		                            song_index)
+		self.config.dry_run = True
+		sd = fplsync.SyncDirector(self.config)
+		sd.add_playlist(playlist)
+		sd.add_songs(playlist, randomly=True)
+		sd.export_plan(plan_path)
+		sd.transfer()
+
+		self.config.dry_run = False
+		sd = fplsync.SyncDirector(self.config)
+		sd.apply_plan(plan_path)
+		self.assertEqual(sorted(song.dest_relative_path for song in sd.songs), ["a.mp3", "c.mp3"])
+		self.assertEqual(sd.playlist_files, {"list.m3u8": playlist.render(self.config)})
+		sd.transfer()
+		self.assertEqual(sorted(os.listdir(self.config.dest)),
+		                 [fplsync.Manifest.file_name, "a.mp3", "c.mp3"])
+		self.assertEqual(os.listdir(self.config.playlist_dest), ["list.m3u8"])
+
+		# dest has changed since, so the plan can't be trusted
+		sd = fplsync.SyncDirector(self.config)
+		with self.assertRaises(Exception):
+			sd.apply_plan(plan_path)
+		shutil.rmtree(sd.temp_dir)
+
+	def test_link(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.link = "hardlink"
+		self.config.validate()
+		self.assertEqual(self.config.engine, "native")
+		song_index = fplsync.SongIndex(self.config)
+		sd = fplsync.SyncDirector(self.config)
+		sd.add_songs([song_index.get_song("F:\\Music\\a.mp3"), song_index.get_song("F:\\Music\\b.mp3")])
+		sd.transfer()
+		self.assertEqual(sd.stats.counters.get("songs_hardlinked"), 2)
+		self.assertEqual(os.stat(os.path.join(self.config.dest, "a.mp3")).st_ino,
+		                 os.stat(os.path.join(self.config.source, "a.mp3")).st_ino)
+
+		# reflinks aren't supported everywhere, but either way the song ends up copied
+		source_path = os.path.join(self.config.source, "c.mp3")
+		for link in ["reflink", "auto"]:
+			dest_path = os.path.join(self.config.dest, link + ".mp3")
+			how = fplsync.copy_file(source_path, dest_path, link)
+			self.assertIn(how, ["reflink", "hardlink", "copy"])
+			with open(dest_path) as f:
+				self.assertEqual(f.read(), "c" * 1000)
+			self.assertEqual(os.path.getmtime(dest_path), os.path.getmtime(source_path))
+			self.assertEqual(os.listdir(self.config.dest).count(link + ".mp3.fplsync-tmp"), 0)
+
+	def test_verify(self):
+		self.config.fb2k_source_mapping = "F:\\Music"
+		self.config.engine = "native"
+		self.config.verify = "report"
+		self.config.cache_dir = os.path.join(os.path.dirname(self.config.dest), "cache")
+		os.mkdir(self.config.cache_dir)
+		song_index = fplsync.SongIndex(self.config)
+		songs = [song_index.get_song("F:\\Music\\a.mp3"), song_index.get_song("F:\\Music\\b.mp3")]
+		sd = fplsync.SyncDirector(self.config)
+		sd.add_songs(songs)
+		sd.transfer()
+		self.assertEqual(sd.stats.counters["bytes_verified"], 4000)
+		self.assertIn("a.mp3", os.listdir(self.config.dest))
+
+		# same size and mtime, so only hashing can tell
+		b_path = os.path.join(self.config.dest, "b.mp3")
+		with open(b_path, "w") as f:
+			f.write("x" * 1000)
+		os.utime(b_path, ns=(0, os.stat(os.path.join(self.config.source, "b.mp3")).st_mtime_ns))
+		sd = fplsync.SyncDirector(self.config)
+		sd.add_songs(songs)
+		self.assertEqual(sd.verify_songs(), [songs[1]])
+		# source hashes came from the cache
+		self.assertEqual(sd.stats.counters["hashes_cached"], 2)
+		self.assertEqual(sd.stats.counters["bytes_verified"], 2000)
+
+		self.config.verify = "fix"
+		self.assertEqual(sd.verify_songs(), [])
+		with open(b_path) as f:
+			self.assertEqual(f.read(), "b" * 1000)
+		shutil.rmtree(sd.temp_dir)